@@ -1,92 +1,505 @@
-from flask import Flask, request, jsonify
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, request, jsonify, g, Response
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
 import os
-import json
+import logging
+import logging.handlers
+import re
+import base64
+import orjson
+import redis
 from datetime import datetime
 from dotenv import load_dotenv
 import subprocess
 import sys
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from functools import wraps
+from cachetools import TTLCache
 
 # Load environment variables FIRST
 load_dotenv()
 
+# Records are buffered and written in batches; errors flush immediately and a
+# background task flushes the rest once a second (see below)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+log_buffer = logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=_log_stream)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), handlers=[log_buffer])
+logger = logging.getLogger('chicrypt')
+
 from database import Database
 from utils import (
     generate_link_token, 
     generate_fetch_token, 
     hash_token,
     generate_challenge_nonce,
-    validate_public_key,
-    verify_signature,
+    decode_and_validate_public_key,
+    verify_signature_async,
     sanitize_input,
     create_response
 )
 
-def run_migrations():
-    """Check if database needs setup and run migrations if needed"""
+def alembic_command(*args):
+    """Run an alembic command from the project directory; returns the CompletedProcess"""
+    return subprocess.run(
+        ['alembic', *args],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+
+def alembic_upgrade():
+    """Run `alembic upgrade head` (idempotent); returns the CompletedProcess"""
+    return alembic_command('upgrade', 'head')
+
+def unversioned_schema_revision(cursor):
+    """
+    Revision matching a database built by init_database without Alembic
+    The current init_database builds the 009 schema (idx_link_size and all);
+    databases from earlier releases match 003 and still need 004-009.
+    """
+    cursor.execute("SHOW INDEX FROM messages WHERE Key_name = 'idx_link_size'")
+    return '009' if cursor.fetchall() else '003'
+
+def run_migrations(db, upgrade_existing=False):
+    """
+    Check if database needs setup and run migrations if needed
+    An empty database is always migrated; an existing one is only upgraded to
+    head when upgrade_existing is set (the `flask migrate` command).
+    """
     try:
         # Check if database connection works
-        db_test = Database()
-        if not db_test.connected:
-            print("WARNING: Database not connected. Skipping migrations.")
-            print("   Set up your database and configure .env file for production.")
+        if not db.connected:
+            logger.warning("Database not connected. Skipping migrations. "
+                           "Set up your database and configure .env file for production.")
             return False
         
         # Check if tables exist
         try:
-            with db_test.connection.cursor() as cursor:
+            with db.pool.connection() as conn, conn.cursor() as cursor:
                 cursor.execute("SHOW TABLES")
-                tables = cursor.fetchall()
+                tables = [next(iter(row.values())) for row in cursor.fetchall()]
                 table_count = len(tables)
                 
                 if table_count == 0:
-                    print("INFO: No tables found. Running initial migration...")
+                    logger.info("No tables found. Running initial migration...")
                     # Run alembic upgrade
-                    result = subprocess.run(
-                        ['alembic', 'upgrade', 'head'],
-                        cwd=os.path.dirname(os.path.abspath(__file__)),
-                        capture_output=True,
-                        text=True
-                    )
+                    result = alembic_upgrade()
                     
                     if result.returncode == 0:
-                        print("SUCCESS: Database tables created successfully!")
+                        logger.info("Database tables created successfully")
                         return True
                     else:
-                        print("ERROR: Migration failed: {}".format(result.stderr))
+                        logger.error("Migration failed: %s", result.stderr)
                         # Fallback to init_database
-                        print("INFO: Trying fallback initialization...")
-                        db_test.init_database()
-                        print("SUCCESS: Database initialized using fallback method")
+                        logger.info("Trying fallback initialization...")
+                        db.init_database()
+                        logger.info("Database initialized using fallback method")
                         return True
-                else:
-                    print("INFO: Database already set up ({} tables found)".format(table_count))
+                elif not upgrade_existing:
+                    logger.info("Database already set up (%d tables found)", table_count)
                     return True
+                elif 'alembic_version' not in tables:
+                    # Created by init_database: record the revision its schema
+                    # matches, then let the upgrade below apply the rest
+                    revision = unversioned_schema_revision(cursor)
+                    logger.warning("Database has no alembic_version table (created without Alembic); "
+                                   "stamping it at revision %s", revision)
+                    result = alembic_command('stamp', revision)
+                    if result.returncode != 0:
+                        logger.error("Stamping failed: %s", result.stderr)
+                        return False
                     
         except Exception as e:
-            print("Error checking database: {}".format(e))
-            print("INFO: Attempting to initialize database...")
-            db_test.init_database()
+            logger.error("Error checking database: %s", e)
+            logger.info("Attempting to initialize database...")
+            db.init_database()
             return True
+        
+        # Existing database: bring it to head (no-op when already current)
+        logger.info("Upgrading existing database to the latest migration...")
+        result = alembic_upgrade()
+        if result.returncode != 0:
+            logger.error("Migration failed: %s", result.stderr)
+            return False
+        logger.info("Database schema is up to date")
+        return True
             
     except Exception as e:
-        print("WARNING: Database setup check failed: {}".format(e))
+        logger.warning("Database setup check failed: %s", e)
         return False
 
+BASE_URL = os.getenv('BASE_URL', 'http://localhost:5000')
+SUPPORTED_KEY_TYPES = frozenset({'ed25519'})
+MAX_MSG_BYTES = 16 * 1024
+MAX_META_BYTES = 4 * 1024
+# Per-recipient cap on stored ciphertext bytes; 0 disables it
+MAX_MAILBOX_BYTES = int(os.getenv('MAX_MAILBOX_BYTES', 0))
+BASE64_RE = re.compile(r'[A-Za-z0-9+/]*={0,2}')
+
+def missing_fields(data, *keys):
+    """Return the required keys absent from a JSON body (all of them if it isn't an object)"""
+    if not isinstance(data, dict):
+        return list(keys)
+    return [key for key in keys if key not in data]
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson for request parsing and jsonify"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
+# gzip JSON responses over COMPRESS_MIN_SIZE (500 B). Flask-Compress only
+# gzips buffered responses (streams get br/deflate/zstd at most), which is why
+# /fetch builds its body in one piece
+Compress(app)
 
-# Run migrations on startup
-print("\nStarting ChiCrypt Server...")
-run_migrations()
+logger.info("Starting ChiCrypt Server...")
 
-# Initialize database
+# Initialize database (shared connection pool)
 db = Database()
+# Registered before the write buffer's flush, so it runs after it at exit
+atexit.register(db.close_connection)
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create or upgrade the database schema (run once before starting workers)"""
+    if not run_migrations(db, upgrade_existing=True):
+        sys.exit(1)
+
+def start_periodic_task(interval, func):
+    """Run func every interval seconds on a daemon thread"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                func()
+            except Exception:
+                logger.exception("Periodic task %s failed", func.__name__)
+    
+    thread = threading.Thread(target=loop, name=func.__name__, daemon=True)
+    thread.start()
+    return thread
+
+# Client rows are immutable after registration (public_key, link_token), so
+# hot clients are served from process memory; the TTL bounds staleness.
+_client_cache = TTLCache(maxsize=10000, ttl=60)
+_client_cache_lock = threading.RLock()
+
+def _lookup_client(link_token):
+    """Get a client by link token, consulting the in-process cache first"""
+    with _client_cache_lock:
+        client = _client_cache.get(link_token)
+    if client is not None:
+        return client
+    
+    client = db.get_client_by_link_token(link_token)
+    # Only cache hits: a missing token may be registered a moment later
+    if client:
+        with _client_cache_lock:
+            _client_cache[link_token] = client
+    return client
+
+# Lookups in flight, keyed by (endpoint, key): concurrent identical reads wait
+# on the first caller's Future instead of each issuing the same query
+_inflight = {}
+_inflight_lock = threading.Lock()
+# Followers stop waiting on a stuck leader after this and run the lookup themselves
+SINGLEFLIGHT_WAIT_SECONDS = 5
+
+def _singleflight(key, func, *args):
+    """Run func(*args) once for all concurrent callers sharing key"""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        try:
+            return future.result(timeout=SINGLEFLIGHT_WAIT_SECONDS)
+        except FutureTimeoutError:
+            return func(*args)
+    try:
+        result = func(*args)
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        # gevent.Timeout and GreenletExit are BaseExceptions; never leave
+        # followers waiting on a Future the leader abandoned
+        if not future.done():
+            future.set_exception(RuntimeError('Lookup was interrupted'))
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+MAX_OUTSTANDING_CHALLENGES = 5
+CHALLENGE_COOLDOWN_SECONDS = 3
+CHALLENGE_TTL_SECONDS = 300
+
+# Optional Redis for challenge rate limiting; falls back to MySQL when unset
+REDIS_URL = os.getenv('REDIS_URL')
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# DECR that never leaves the counter below zero; the key is dropped at zero
+# so the next INCR starts a fresh TTL window
+_RELEASE_SLOT_SCRIPT = """
+local n = redis.call('DECR', KEYS[1])
+if n <= 0 then redis.call('DEL', KEYS[1]) end
+return n
+"""
+_release_slot = redis_client.register_script(_RELEASE_SLOT_SCRIPT) if redis_client is not None else None
+
+def _challenge_rate_limit_redis(link_token):
+    """Rate-limit challenge requests with Redis counters (one pipelined round-trip)"""
+    outstanding_key = f'rl:out:{link_token}'
+    cooldown_key = f'rl:cool:{link_token}'
+    pipe = redis_client.pipeline()
+    pipe.set(cooldown_key, 1, nx=True, ex=CHALLENGE_COOLDOWN_SECONDS)
+    pipe.incr(outstanding_key)
+    cooldown_started, outstanding = pipe.execute()
+    
+    # Only the request that creates the counter sets its TTL; refreshing it on
+    # every call would let a busy client keep the counter alive forever
+    if outstanding == 1:
+        redis_client.expire(outstanding_key, CHALLENGE_TTL_SECONDS)
+    
+    if not cooldown_started:
+        _release_slot(keys=[outstanding_key])
+        return 'Challenge requested too frequently'
+    if outstanding > MAX_OUTSTANDING_CHALLENGES:
+        _release_slot(keys=[outstanding_key])
+        return 'Too many outstanding challenges'
+    return None
+
+def _challenge_rate_limit_db(link_token):
+    """Rate-limit challenge requests from the challenges table"""
+    try:
+        with db.pool.connection() as conn, conn.cursor() as cursor:
+            # Outstanding count and age of the newest challenge in one round-trip
+            cursor.execute("""
+                SELECT SUM(used=FALSE AND expires_at>NOW()) AS cnt,
+                       TIMESTAMPDIFF(SECOND, MAX(created_at), NOW()) AS age
+                FROM challenges WHERE link_token=%s
+            """, (link_token,))
+            row = cursor.fetchone()
+            if row and row['cnt'] is not None and row['cnt'] >= MAX_OUTSTANDING_CHALLENGES:
+                return 'Too many outstanding challenges'
+            if row and row['age'] is not None and row['age'] < CHALLENGE_COOLDOWN_SECONDS:
+                return 'Challenge requested too frequently'
+    except Exception:
+        pass
+    return None
+
+def check_challenge_rate_limit(link_token):
+    """Return an error message if link_token may not request a challenge now"""
+    if redis_client is not None:
+        try:
+            return _challenge_rate_limit_redis(link_token)
+        except redis.RedisError as e:
+            logger.warning("Redis rate limit unavailable, using database: %s", e)
+    return _challenge_rate_limit_db(link_token)
+
+def release_challenge_slot(link_token):
+    """Free an outstanding-challenge slot once a challenge is consumed or was never stored"""
+    if redis_client is None:
+        return
+    try:
+        _release_slot(keys=[f'rl:out:{link_token}'])
+    except redis.RedisError:
+        pass
+
+def require_auth(f):
+    """
+    Authenticate the request for the client identified by link_token.
+    Accepts either a signed challenge (challenge + challenge_signature in the
+    body) or a fetch token (Authorization: Bearer <fetch_token>).
+    On success sets g.client and g.auth_method before calling the view.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            data = request.get_json(cache=True, silent=True) or {}
+            
+            missing = missing_fields(data, 'link_token')
+            if missing:
+                return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
+            
+            link_token = data['link_token']
+            if not isinstance(link_token, str):
+                return jsonify({'error': 'link_token must be a string'}), 400
+            
+            # Get client
+            client = _lookup_client(link_token)
+            if not client:
+                return jsonify({'error': 'Invalid link_token'}), 404
+            
+            auth_header = request.headers.get('Authorization')
+            challenge_signature = data.get('challenge_signature')
+            challenge_nonce = data.get('challenge')
+            
+            if not isinstance(challenge_signature or '', str) or not isinstance(challenge_nonce or '', str):
+                return jsonify({'error': 'challenge and challenge_signature must be strings'}), 400
+            
+            # Method 1: Challenge-response (stronger)
+            if challenge_signature and challenge_nonce:
+                message_to_verify = challenge_nonce.encode('utf-8')
+                # Verified on the shared pool so the check doesn't block this worker's event loop
+                if not verify_signature_async(client['public_key'], message_to_verify, challenge_signature).result():
+                    return jsonify({'error': 'Invalid signature'}), 401
+                
+                # Atomically consume the challenge (must exist, be unexpired and unused)
+                if not db.consume_challenge(link_token, challenge_nonce):
+                    return jsonify({'error': 'Invalid or expired challenge'}), 401
+                release_challenge_slot(link_token)
+                g.auth_method = 'challenge'
+            
+            # Method 2: Fetch token (simpler but less secure)
+            elif auth_header and auth_header.startswith('Bearer '):
+                fetch_token = auth_header[len('Bearer '):]
+                if not db.verify_fetch_token(link_token, fetch_token):
+                    return jsonify({'error': 'Invalid fetch_token'}), 401
+                g.auth_method = 'fetch_token'
+            else:
+                return jsonify({'error': 'Authentication required (challenge_signature or Authorization header)'}), 401
+            
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+            
+        g.client = client
+        return f(*args, **kwargs)
+    
+    return wrapper
+
+LOG_FLUSH_INTERVAL = 1
+start_periodic_task(LOG_FLUSH_INTERVAL, log_buffer.flush)
+
+# Expired challenges are purged in the background, not on /challenge_request
+CHALLENGE_CLEANUP_INTERVAL = 60
+start_periodic_task(CHALLENGE_CLEANUP_INTERVAL, db.cleanup_old_challenges)
+
+class MessageWriteBuffer:
+    """
+    Write-behind queue for /send requests that opt out of a synchronous
+    commit (ack=false). A daemon thread waits for the first queued message,
+    keeps collecting until the flush window closes or the batch is full,
+    then inserts them with one multi-row INSERT. If that INSERT fails the
+    batch is retried one row at a time, so one bad row can't drop the rest.
+    """
+    
+    def __init__(self, db, interval=0.1, max_batch=256):
+        self.db = db
+        self.interval = interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        # link_token -> ciphertext bytes queued but not yet written, so the
+        # mailbox quota also counts messages that haven't reached MySQL yet
+        self._pending_bytes = {}
+        self._pending_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+    
+    def put(self, link_token, encrypted_message, metadata=None):
+        with self._pending_lock:
+            self._pending_bytes[link_token] = self._pending_bytes.get(link_token, 0) + len(encrypted_message)
+        self._queue.put((link_token, encrypted_message, metadata))
+    
+    def pending_bytes(self, link_token):
+        """Ciphertext bytes queued for link_token and not yet written"""
+        return self._pending_bytes.get(link_token, 0)
+    
+    def _drain(self, rows):
+        while len(rows) < self.max_batch:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+    
+    def _write(self, rows):
+        try:
+            self.db.store_messages_bulk(rows)
+        except Exception:
+            logger.warning("Bulk write of %d buffered messages failed, retrying one by one", len(rows))
+            for row in rows:
+                try:
+                    self.db.store_message(*row)
+                except Exception:
+                    logger.exception("Failed to write a buffered message")
+        finally:
+            with self._pending_lock:
+                for link_token, encrypted_message, _ in rows:
+                    remaining = self._pending_bytes.get(link_token, 0) - len(encrypted_message)
+                    if remaining > 0:
+                        self._pending_bytes[link_token] = remaining
+                    else:
+                        self._pending_bytes.pop(link_token, None)
+            for _ in rows:
+                self._queue.task_done()
+    
+    def _run(self):
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(rows) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(rows)
+    
+    def flush(self):
+        """Write everything still queued and wait for the batch the writer
+        thread is holding (used at shutdown)
+        """
+        rows = self._drain([])
+        while rows:
+            self._write(rows)
+            rows = self._drain([])
+        # Rows the writer thread has already dequeued are only marked done
+        # once written
+        self._queue.join()
+
+message_writer = MessageWriteBuffer(db)
+atexit.register(message_writer.flush)
+
+# Health probes are frequent, so the payload is pre-serialized once a second
+HEALTH_REFRESH_INTERVAL = 1
+_health_body = b''
+
+def refresh_health_body():
+    global _health_body
+    _health_body = orjson.dumps({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
+
+refresh_health_body()
+start_periodic_task(HEALTH_REFRESH_INTERVAL, refresh_health_body)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
+    return Response(_health_body, mimetype='application/json')
 
 @app.route('/register', methods=['POST'])
 def register():
@@ -95,21 +508,22 @@ def register():
     Returns a link_token (for sharing) and fetch_token (for authentication)
     """
     try:
-        data = request.get_json()
+        data = request.get_json(cache=True, silent=True) or {}
         
-        if not data or 'public_key' not in data:
-            return jsonify({'error': 'Public key is required'}), 400
+        missing = missing_fields(data, 'public_key')
+        if missing:
+            return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
             
         public_key = data['public_key']
         display_name = sanitize_input(data.get('display_name'))
         key_type = data.get('key_type', 'ed25519')
         
         # Validate key_type (only Ed25519 supported)
-        if key_type not in ['ed25519']:
+        if key_type not in SUPPORTED_KEY_TYPES:
             return jsonify({'error': 'Unsupported key_type. Only ed25519 is supported.'}), 400
         
-        # Validate the public key format
-        if not validate_public_key(public_key):
+        # Validate the public key format (also primes the VerifyKey cache)
+        if decode_and_validate_public_key(public_key) is None:
             return jsonify({'error': 'Invalid public key format'}), 400
             
         # Generate tokens
@@ -127,8 +541,7 @@ def register():
         )
         
         # Construct shareable link
-        base_url = os.getenv('BASE_URL', 'http://localhost:5000')
-        shareable_link = f"{base_url}/l/{link_token}"
+        shareable_link = f"{BASE_URL}/l/{link_token}"
         
         return jsonify({
             'message': 'Client registered successfully',
@@ -150,40 +563,44 @@ def send_message():
     Otherwise allows anonymous sending with just link_token (backward compatible)
     """
     try:
-        data = request.get_json()
+        data = request.get_json(cache=True, silent=True) or {}
         
-        if not data or 'link_token' not in data or 'encrypted_message' not in data:
-            return jsonify({'error': 'link_token and encrypted_message are required'}), 400
+        missing = missing_fields(data, 'link_token', 'encrypted_message')
+        if missing:
+            return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
             
         to_link_token = data['link_token']
         from_link_token = data.get('from_link_token')  # Optional sender identification
         encrypted_message = data['encrypted_message']
         metadata = data.get('metadata')  # Optional metadata
-        # Validate payload sizes
-        try:
-            import base64 as _b64
-            decoded = _b64.b64decode(encrypted_message)
-            if len(decoded) > 16 * 1024:
-                return jsonify({'error': 'Encrypted message too large (max 16KB)'}), 413
-        except Exception:
+        # Validate payload sizes; base64 is exactly 4 chars per 3 bytes, so the
+        # decoded size follows from the string length without decoding
+        if (not isinstance(encrypted_message, str)
+                or len(encrypted_message) % 4
+                or not BASE64_RE.fullmatch(encrypted_message)):
             return jsonify({'error': 'Invalid base64 for encrypted_message'}), 400
+        decoded_size = len(encrypted_message) // 4 * 3 - encrypted_message.count('=', -2)
+        if decoded_size > MAX_MSG_BYTES:
+            return jsonify({'error': 'Encrypted message too large (max 16KB)'}), 413
         if metadata is not None:
             try:
-                meta_str = json.dumps(metadata)
-                if len(meta_str) > 4 * 1024:
+                meta_bytes = orjson.dumps(metadata)
+                if len(meta_bytes) > MAX_META_BYTES:
                     return jsonify({'error': 'Metadata too large (max 4KB)'}), 413
             except Exception:
                 return jsonify({'error': 'Invalid metadata JSON'}), 400
+        # Ciphertext is stored as raw bytes; base64 only exists on the wire
+        payload = base64.b64decode(encrypted_message)
         
         # Verify that the recipient link_token exists
-        client = db.get_client_by_link_token(to_link_token)
+        client = _lookup_client(to_link_token)
         if not client:
             return jsonify({'error': 'Invalid link_token'}), 404
             
         # If sender is identified, check permission
         if from_link_token:
             # Verify sender exists
-            from_client = db.get_client_by_link_token(from_link_token)
+            from_client = _lookup_client(from_link_token)
             if not from_client:
                 return jsonify({'error': 'Invalid from_link_token'}), 404
                 
@@ -195,10 +612,26 @@ def send_message():
                     'action_required': 'request_permission'
                 }), 403
         
+        # Storage quota, summed from idx_link_size (migration 009) plus any
+        # ack=false messages still waiting in the write buffer
+        if MAX_MAILBOX_BYTES:
+            stored = db.sum_user_storage(to_link_token)['total'] + message_writer.pending_bytes(to_link_token)
+            if stored + len(payload) > MAX_MAILBOX_BYTES:
+                return jsonify({'error': 'Recipient mailbox is full'}), 507
+        
+        # Callers that don't need the id can skip the synchronous commit;
+        # the message is inserted with the next batch
+        if data.get('ack', True) is False:
+            message_writer.put(to_link_token, payload, metadata)
+            return jsonify({
+                'message': 'Message queued',
+                'id': None
+            }), 202
+        
         # Store the encrypted message (server never decrypts it)
         message_id = db.store_message(
             link_token=to_link_token,
-            encrypted_message=encrypted_message,
+            encrypted_message=payload,
             metadata=metadata
         )
         
@@ -217,50 +650,40 @@ def challenge_request():
     Client must sign this challenge to prove they own the private key
     """
     try:
-        data = request.get_json()
+        data = request.get_json(cache=True, silent=True) or {}
         
-        if not data or 'link_token' not in data:
-            return jsonify({'error': 'link_token is required'}), 400
+        missing = missing_fields(data, 'link_token')
+        if missing:
+            return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
             
         link_token = data['link_token']
         
         # Verify that the link_token exists
-        client = db.get_client_by_link_token(link_token)
+        client = _lookup_client(link_token)
         if not client:
             return jsonify({'error': 'Invalid link_token'}), 404
             
         # Rate limiting: max 5 outstanding, cooldown 3s
-        try:
-            with db.connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT COUNT(*) AS cnt FROM challenges 
-                    WHERE link_token=%s AND used=FALSE AND expires_at>NOW()
-                """, (link_token,))
-                row = cursor.fetchone()
-                if row and row['cnt'] >= 5:
-                    return jsonify({'error': 'Too many outstanding challenges'}), 429
-                cursor.execute("""
-                    SELECT TIMESTAMPDIFF(SECOND, created_at, NOW()) AS age
-                    FROM challenges WHERE link_token=%s ORDER BY created_at DESC LIMIT 1
-                """, (link_token,))
-                age = cursor.fetchone()
-                if age and age['age'] is not None and age['age'] < 3:
-                    return jsonify({'error': 'Challenge requested too frequently'}), 429
-        except Exception:
-            pass
+        rate_limit_error = check_challenge_rate_limit(link_token)
+        if rate_limit_error:
+            return jsonify({'error': rate_limit_error}), 429
 
         # Generate a challenge nonce
         challenge_nonce = generate_challenge_nonce()
         client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
         user_agent = request.headers.get('User-Agent', '')
-        db.create_challenge(link_token, challenge_nonce, expires_in_seconds=300, client_ip=client_ip, user_agent=user_agent)
-        db.cleanup_old_challenges()
+        try:
+            db.create_challenge(link_token, challenge_nonce, expires_in_seconds=CHALLENGE_TTL_SECONDS, client_ip=client_ip, user_agent=user_agent)
+        except Exception:
+            release_challenge_slot(link_token)
+            raise
         return jsonify({'challenge': challenge_nonce}), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/fetch', methods=['POST'])
+@require_auth
 def fetch_messages():
     """
     Fetch encrypted messages for a client
@@ -270,64 +693,27 @@ def fetch_messages():
     
     Pagination parameters:
     - limit: number of messages to return (default 50, max 200)
-    - before_id: for infinite scroll (DESC order)
-    - since_id: for polling new messages (ASC order)
+    - before_id + before_created_at: for infinite scroll (DESC order)
+    - since_id + since_created_at: for polling new messages (ASC order)
+    Pass back next_cursor / next_cursor_created_at from the previous page.
     - order: 'ASC' or 'DESC' (default 'DESC')
     """
     try:
-        data = request.get_json()
+        data = request.get_json(cache=True, silent=True) or {}
         
-        if not data or 'link_token' not in data:
-            return jsonify({'error': 'link_token is required'}), 400
+        missing = missing_fields(data, 'link_token')
+        if missing:
+            return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
             
         link_token = data['link_token']
         
-        # Get client
-        client = db.get_client_by_link_token(link_token)
-        if not client:
-            return jsonify({'error': 'Invalid link_token'}), 404
-            
-        # Check authentication method
-        auth_header = request.headers.get('Authorization')
-        challenge_signature = data.get('challenge_signature')
-        challenge_nonce = data.get('challenge')
-        
-        authenticated = False
-        
-        # Method 1: Challenge-response (stronger)
-        if challenge_signature and challenge_nonce:
-            # Verify challenge exists and is valid
-            challenge = db.get_challenge(link_token, challenge_nonce)
-            if not challenge:
-                return jsonify({'error': 'Invalid or expired challenge'}), 401
-                
-            # Verify signature
-            message_to_verify = challenge_nonce.encode('utf-8')
-            if verify_signature(client['public_key'], message_to_verify, challenge_signature):
-                authenticated = True
-                # Mark challenge as used
-                db.mark_challenge_used(challenge['id'])
-            else:
-                return jsonify({'error': 'Invalid signature'}), 401
-                
-        # Method 2: Fetch token (simpler but less secure)
-        elif auth_header and auth_header.startswith('Bearer '):
-            fetch_token = auth_header.split(' ')[1]
-            if db.verify_fetch_token(link_token, fetch_token):
-                authenticated = True
-            else:
-                return jsonify({'error': 'Invalid fetch_token'}), 401
-        else:
-            return jsonify({'error': 'Authentication required (challenge_signature or Authorization header)'}), 401
-            
-        if not authenticated:
-            return jsonify({'error': 'Authentication failed'}), 401
-            
         # Get messages with pagination
         include_seen = data.get('include_seen', False)
         limit = data.get('limit', 50)
         before_id = data.get('before_id')
         since_id = data.get('since_id')
+        before_created_at = data.get('before_created_at')
+        since_created_at = data.get('since_created_at')
         order = data.get('order', 'DESC')
         
         try:
@@ -335,25 +721,28 @@ def fetch_messages():
         except Exception:
             limit = 50
             
+        # One buffered read (at most 200 x 16KB), so the pooled connection is
+        # back in the pool before a slow client starts reading the response
         messages = db.get_messages(
             link_token, 
             include_seen=include_seen, 
             limit=limit, 
             before_id=before_id,
             since_id=since_id,
-            order=order
+            order=order,
+            before_created_at=before_created_at,
+            since_created_at=since_created_at
         )
         
-        # Format response
-        message_list = []
-        for msg in messages:
-            message_list.append({
-                'id': msg['id'],
-                'encrypted_message': msg['encrypted_message'],
-                'created_at': msg['created_at'].isoformat() if msg['created_at'] else None,
-                'seen': msg['seen'],
-                'metadata': json.loads(msg['metadata']) if msg['metadata'] else None
-            })
+        # Built as one body (not streamed) so Flask-Compress gzips it
+        # created_at is already ISO-formatted by the query
+        message_list = [{
+            'id': msg['id'],
+            'encrypted_message': base64.b64encode(msg['encrypted_message'] or b'').decode(),
+            'created_at': msg['created_at_iso'],
+            'seen': msg['seen'],
+            'metadata': orjson.loads(msg['metadata']) if msg['metadata'] else None
+        } for msg in messages]
         
         # Add pagination metadata
         response_data = {
@@ -365,10 +754,8 @@ def fetch_messages():
         
         # Add next_cursor for pagination
         if message_list:
-            if order == 'ASC':
-                response_data['next_cursor'] = message_list[-1]['id']
-            else:
-                response_data['next_cursor'] = message_list[-1]['id']
+            response_data['next_cursor'] = message_list[-1]['id']
+            response_data['next_cursor_created_at'] = message_list[-1]['created_at']
         
         return jsonify(response_data), 200
         
@@ -376,48 +763,22 @@ def fetch_messages():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/ack', methods=['POST'])
+@require_auth
 def acknowledge_messages():
     """
     Mark messages as seen
     Requires authentication (fetch_token or challenge_signature)
     """
     try:
-        data = request.get_json()
+        data = request.get_json(cache=True, silent=True) or {}
         
-        if not data or 'link_token' not in data or 'message_ids' not in data:
-            return jsonify({'error': 'link_token and message_ids are required'}), 400
+        missing = missing_fields(data, 'link_token', 'message_ids')
+        if missing:
+            return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
             
         link_token = data['link_token']
         message_ids = data['message_ids']
         
-        # Get client
-        client = db.get_client_by_link_token(link_token)
-        if not client:
-            return jsonify({'error': 'Invalid link_token'}), 404
-            
-        # Check authentication (same as fetch)
-        auth_header = request.headers.get('Authorization')
-        challenge_signature = data.get('challenge_signature')
-        challenge_nonce = data.get('challenge')
-        
-        authenticated = False
-        
-        if challenge_signature and challenge_nonce:
-            challenge = db.get_challenge(link_token, challenge_nonce)
-            if challenge:
-                message_to_verify = challenge_nonce.encode('utf-8')
-                if verify_signature(client['public_key'], message_to_verify, challenge_signature):
-                    authenticated = True
-                    db.mark_challenge_used(challenge['id'])
-                    
-        elif auth_header and auth_header.startswith('Bearer '):
-            fetch_token = auth_header.split(' ')[1]
-            if db.verify_fetch_token(link_token, fetch_token):
-                authenticated = True
-                
-        if not authenticated:
-            return jsonify({'error': 'Authentication failed'}), 401
-            
         # Mark messages as seen (scoped by link_token)
         db.mark_messages_seen(link_token, message_ids)
         
@@ -436,15 +797,16 @@ def check_contact():
     Returns existence status and nickname if exists
     """
     try:
-        data = request.get_json()
+        data = request.get_json(cache=True, silent=True) or {}
         
-        if not data or 'link_token' not in data:
-            return jsonify({'error': 'link_token is required'}), 400
+        missing = missing_fields(data, 'link_token')
+        if missing:
+            return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
             
         link_token = data['link_token']
         
-        # Get client info
-        client = db.get_client_info_by_link(link_token)
+        # Get client info (shared with concurrent checks of the same link)
+        client = _singleflight(('check_contact', link_token), db.get_client_info_by_link, link_token)
         
         if client:
             return jsonify({
@@ -468,18 +830,19 @@ def request_message_permission():
     Client2 sends request to Client1 before being able to message them
     """
     try:
-        data = request.get_json()
+        data = request.get_json(cache=True, silent=True) or {}
         
-        if not data or 'from_link_token' not in data or 'to_link_token' not in data:
-            return jsonify({'error': 'from_link_token and to_link_token are required'}), 400
+        missing = missing_fields(data, 'from_link_token', 'to_link_token')
+        if missing:
+            return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
             
         from_link_token = data['from_link_token']
         to_link_token = data['to_link_token']
         from_nickname = sanitize_input(data.get('from_nickname', 'Anonymous'))
         
         # Verify both clients exist
-        from_client = db.get_client_by_link_token(from_link_token)
-        to_client = db.get_client_by_link_token(to_link_token)
+        from_client = _lookup_client(from_link_token)
+        to_client = _lookup_client(to_link_token)
         
         if not from_client:
             return jsonify({'error': 'Invalid from_link_token'}), 404
@@ -508,58 +871,30 @@ def request_message_permission():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/get_message_requests', methods=['POST'])
+@require_auth
 def get_message_requests():
     """
     Get pending message requests for a client
     Requires authentication
     """
     try:
-        data = request.get_json()
+        data = request.get_json(cache=True, silent=True) or {}
         
-        if not data or 'link_token' not in data:
-            return jsonify({'error': 'link_token is required'}), 400
+        missing = missing_fields(data, 'link_token')
+        if missing:
+            return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
             
         link_token = data['link_token']
         
-        # Get client
-        client = db.get_client_by_link_token(link_token)
-        if not client:
-            return jsonify({'error': 'Invalid link_token'}), 404
-            
-        # Check authentication
-        auth_header = request.headers.get('Authorization')
-        challenge_signature = data.get('challenge_signature')
-        challenge_nonce = data.get('challenge')
-        
-        authenticated = False
-        
-        if challenge_signature and challenge_nonce:
-            challenge = db.get_challenge(link_token, challenge_nonce)
-            if challenge:
-                message_to_verify = challenge_nonce.encode('utf-8')
-                if verify_signature(client['public_key'], message_to_verify, challenge_signature):
-                    authenticated = True
-                    db.mark_challenge_used(challenge['id'])
-                    
-        elif auth_header and auth_header.startswith('Bearer '):
-            fetch_token = auth_header.split(' ')[1]
-            if db.verify_fetch_token(link_token, fetch_token):
-                authenticated = True
-                
-        if not authenticated:
-            return jsonify({'error': 'Authentication failed'}), 401
-            
         # Get pending requests
         requests = db.get_pending_requests(link_token)
         
-        request_list = []
-        for req in requests:
-            request_list.append({
-                'id': req['id'],
-                'from_link_token': req['from_link_token'],
-                'from_nickname': req['from_nickname'],
-                'created_at': req['created_at'].isoformat() if req['created_at'] else None
-            })
+        request_list = [{
+            'id': req['id'],
+            'from_link_token': req['from_link_token'],
+            'from_nickname': req['from_nickname'],
+            'created_at': req['created_at'].isoformat() if req['created_at'] else None
+        } for req in requests]
         
         return jsonify({
             'message': 'Requests retrieved successfully',
@@ -570,16 +905,18 @@ def get_message_requests():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/respond_message_request', methods=['POST'])
+@require_auth
 def respond_message_request():
     """
     Accept or reject a message request
     Requires authentication from the recipient (to_link_token)
     """
     try:
-        data = request.get_json()
+        data = request.get_json(cache=True, silent=True) or {}
         
-        if not data or 'link_token' not in data or 'request_id' not in data or 'action' not in data:
-            return jsonify({'error': 'link_token, request_id, and action are required'}), 400
+        missing = missing_fields(data, 'link_token', 'request_id', 'action')
+        if missing:
+            return jsonify({'error': 'Missing required fields: {}'.format(', '.join(missing))}), 400
             
         link_token = data['link_token']
         request_id = data['request_id']
@@ -588,34 +925,6 @@ def respond_message_request():
         if action not in ['accept', 'reject']:
             return jsonify({'error': 'action must be "accept" or "reject"'}), 400
             
-        # Get client
-        client = db.get_client_by_link_token(link_token)
-        if not client:
-            return jsonify({'error': 'Invalid link_token'}), 404
-            
-        # Check authentication
-        auth_header = request.headers.get('Authorization')
-        challenge_signature = data.get('challenge_signature')
-        challenge_nonce = data.get('challenge')
-        
-        authenticated = False
-        
-        if challenge_signature and challenge_nonce:
-            challenge = db.get_challenge(link_token, challenge_nonce)
-            if challenge:
-                message_to_verify = challenge_nonce.encode('utf-8')
-                if verify_signature(client['public_key'], message_to_verify, challenge_signature):
-                    authenticated = True
-                    db.mark_challenge_used(challenge['id'])
-                    
-        elif auth_header and auth_header.startswith('Bearer '):
-            fetch_token = auth_header.split(' ')[1]
-            if db.verify_fetch_token(link_token, fetch_token):
-                authenticated = True
-                
-        if not authenticated:
-            return jsonify({'error': 'Authentication failed'}), 401
-            
         # Get the request and verify it belongs to this client
         request_info = db.get_request_by_id(request_id)
         if not request_info:
@@ -640,12 +949,58 @@ def respond_message_request():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-if __name__ == '__main__':
-    # Initialize database tables
-    db.init_database()
-    
-    # Run the application
-    port = int(os.environ.get('PORT', 5000))
-    debug_mode = os.environ.get('DEBUG', 'False').lower() == 'true'
-    
-    app.run(host='0.0.0.0', port=port, debug=debug_mode)
\ No newline at end of file
+# POST routes that /batch may run; /batch itself is excluded so pipelines can't nest
+BATCH_PATHS = frozenset({
+    '/register', '/send', '/challenge_request', '/fetch', '/ack', '/check_contact',
+    '/request_message_permission', '/get_message_requests', '/respond_message_request'
+})
+MAX_BATCH_ITEMS = 20
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Run several API calls in one HTTP request
+    Body: {"pipeline": [{"path": "/register", "body": {...}, "headers": {...}}, ...]}
+    Steps run in order through the normal routes (auth, validation and rate
+    limits included) and results come back in the same order.
+    """
+    try:
+        data = request.get_json(cache=True, silent=True) or {}
+        pipeline = data.get('pipeline') if isinstance(data, dict) else None
+        
+        if not isinstance(pipeline, list) or not pipeline:
+            return jsonify({'error': 'pipeline must be a non-empty list'}), 400
+        if len(pipeline) > MAX_BATCH_ITEMS:
+            return jsonify({'error': f'Too many pipeline steps (max {MAX_BATCH_ITEMS})'}), 400
+        for step in pipeline:
+            path = step.get('path') if isinstance(step, dict) else None
+            if not isinstance(path, str) or path not in BATCH_PATHS:
+                return jsonify({'error': 'Each step needs a supported path'}), 400
+            if not isinstance(step.get('body') or {}, dict):
+                return jsonify({'error': 'Step body must be a JSON object'}), 400
+        
+        # Inner calls keep the caller's address; only Authorization is forwarded
+        client_ip = request.headers.get('X-Forwarded-For', request.remote_addr) or ''
+        environ_base = {'REMOTE_ADDR': request.remote_addr or ''}
+        user_agent = request.headers.get('User-Agent', '')
+        
+        results = []
+        with app.test_client() as client:
+            for step in pipeline:
+                headers = {'X-Forwarded-For': client_ip, 'User-Agent': user_agent}
+                step_headers = step.get('headers')
+                if isinstance(step_headers, dict) and step_headers.get('Authorization'):
+                    headers['Authorization'] = step_headers['Authorization']
+                
+                response = client.post(step['path'], json=step.get('body') or {},
+                                       headers=headers, environ_base=environ_base)
+                try:
+                    body = orjson.loads(response.get_data())
+                except orjson.JSONDecodeError:
+                    body = None
+                results.append({'status': response.status_code, 'body': body})
+        
+        return jsonify({'results': results}), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
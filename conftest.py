@@ -0,0 +1,64 @@
+"""
+pytest configuration for the API tests in test_suite.py and test_permissions.py
+The client is registered once per session through conftest_fixtures, and the
+API tests are skipped when the server at TEST_BASE_URL is not reachable
+(test_database.py needs neither).
+"""
+
+import os
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+from conftest_fixtures import get_fixture, TIMEOUT
+
+BASE_URL = os.environ.get('TEST_BASE_URL', 'http://localhost:5000')
+
+# The standalone scripts run their checks at import time; run them directly
+collect_ignore = ['test_api.py', 'test_edge_cases.py', 'test_enhancements.py', 'test_new_api.py']
+
+@pytest.fixture(scope='session')
+def base_url():
+    return BASE_URL
+
+@pytest.fixture(scope='session')
+def session(base_url):
+    http = requests.Session()
+    http.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=0))
+    try:
+        http.get(f'{base_url}/health', timeout=TIMEOUT)
+    except requests.RequestException as e:
+        pytest.skip(f"API server not reachable at {base_url}: {e}")
+    yield http
+    http.close()
+
+@pytest.fixture(scope='session')
+def server_available(session):
+    """Skip API tests when the server is down instead of failing them
+    (applied with pytestmark in the modules that need the server)
+    """
+
+@pytest.fixture(scope='session')
+def client(base_url, session):
+    return get_fixture(base_url, session)
+
+@pytest.fixture(scope='session')
+def signing_key(client):
+    return client.signing_key
+
+@pytest.fixture(scope='session')
+def link_token(client):
+    return client.link_token
+
+@pytest.fixture(scope='session')
+def fetch_token(client):
+    return client.fetch_token
+
+@pytest.fixture(scope='session')
+def sealed_box(client):
+    return client.sealed_box
+
+@pytest.fixture(scope='session')
+def auth_headers(fetch_token):
+    return {"Authorization": f"Bearer {fetch_token}"}
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Shared client fixture and helpers for the API test scripts
+Registers one test client and caches its keys and tokens in .test_fixture.json,
+so repeated runs skip keygen and /register. Only the base64 key seeds and token
+strings are stored; the NaCl objects are rebuilt on load.
+"""
+
+import atexit
+import io
+import base64
+import json
+import os
+import sys
+from binascii import b2a_base64
+from pathlib import Path
+from types import SimpleNamespace
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from nacl.public import PrivateKey, SealedBox
+from nacl.signing import SigningKey
+from nacl.encoding import Base64Encoder
+
+FIXTURE_PATH = Path(__file__).with_name('.test_fixture.json')
+
+# (connect, read) seconds; a hung server fails the run instead of blocking it
+TIMEOUT = (1.0, 2.0)
+
+# Stand-in ciphertext for negative-path tests: the server only checks base64
+# shape and size, so these never need a real sealed box
+FAKE_CT_B64 = "YWJjZA=="
+
+def b64e(data):
+    """Base64-encode bytes to str without base64's wrapper layers"""
+    return b2a_base64(data, newline=False).decode('ascii')
+
+def sign_challenge(signing_key, nonce):
+    """Base64 Ed25519 signature of a challenge nonce, as /fetch expects it"""
+    return b64e(signing_key.sign(nonce.encode('utf-8')).signature)
+
+# Output is buffered and written once per test group instead of per line
+_report_buf = io.StringIO()
+
+def report(line=''):
+    _report_buf.write(line + '\n')
+
+def flush_report():
+    sys.stdout.write(_report_buf.getvalue())
+    sys.stdout.flush()
+    _report_buf.seek(0)
+    _report_buf.truncate()
+
+def section(title):
+    """Start a test group, flushing the previous group's output"""
+    flush_report()
+    report('\n' + title)
+
+# Also covers exit(1) and uncaught errors part-way through a group
+atexit.register(flush_report)
+
+# One pooled keep-alive session for the whole script
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=0))
+session.headers['Content-Type'] = 'application/json'
+
+def post(url, obj, headers=None):
+    """POST obj as a JSON body encoded with orjson"""
+    return session.post(url, data=orjson.dumps(obj), headers=headers, timeout=TIMEOUT)
+
+def _build(base_url, signing_seed, encryption_key, link_token, fetch_token):
+    signing_key = SigningKey(signing_seed)
+    encryption_private_key = PrivateKey(encryption_key)
+    return SimpleNamespace(
+        base_url=base_url,
+        signing_key=signing_key,
+        public_key_b64=signing_key.verify_key.encode(encoder=Base64Encoder).decode('utf-8'),
+        encryption_private_key=encryption_private_key,
+        sealed_box=SealedBox(encryption_private_key.public_key),
+        link_token=link_token,
+        fetch_token=fetch_token
+    )
+
+def _load(base_url, session):
+    """Return the cached fixture if it is for this server and still registered"""
+    if os.environ.get('TEST_FRESH_FIXTURE') or not FIXTURE_PATH.exists():
+        return None
+    try:
+        with FIXTURE_PATH.open() as f:
+            cached = json.load(f)
+        if cached.get('base_url') != base_url:
+            return None
+        cached['signing_seed'] = base64.b64decode(cached['signing_seed'])
+        cached['encryption_key'] = base64.b64decode(cached['encryption_key'])
+    except Exception:
+        return None
+
+    # The database may have been reset since the fixture was written
+    response = session.post(f'{base_url}/check_contact', json={'link_token': cached['link_token']},
+                            timeout=TIMEOUT)
+    if response.status_code != 200 or not response.json().get('exists'):
+        return None
+    return cached
+
+def get_fixture(base_url, session=None, display_name='Test Fixture User'):
+    """
+    Get a registered test client for base_url
+    Returns a namespace with signing_key, public_key_b64, encryption_private_key,
+    sealed_box, link_token and fetch_token
+    """
+    session = session or requests.Session()
+    cached = _load(base_url, session)
+    if cached is None:
+        signing_key = SigningKey.generate()
+        encryption_private_key = PrivateKey.generate()
+        registration_data = {
+            "public_key": signing_key.verify_key.encode(encoder=Base64Encoder).decode('utf-8'),
+            "display_name": display_name
+        }
+        response = session.post(f'{base_url}/register', json=registration_data, timeout=TIMEOUT)
+        if response.status_code != 201:
+            raise RuntimeError(f"Fixture registration failed ({response.status_code}): {response.text}")
+        reg_result = response.json()
+        cached = {
+            'base_url': base_url,
+            'signing_seed': bytes(signing_key),
+            'encryption_key': bytes(encryption_private_key),
+            'link_token': reg_result['link_token'],
+            'fetch_token': reg_result['fetch_token']
+        }
+        # Write then rename, so parallel pytest-xdist workers never read a
+        # half-written file
+        tmp_path = FIXTURE_PATH.with_name(f'{FIXTURE_PATH.name}.{os.getpid()}.tmp')
+        with tmp_path.open('w') as f:
+            json.dump({**cached,
+                       'signing_seed': b64e(cached['signing_seed']),
+                       'encryption_key': b64e(cached['encryption_key'])}, f)
+        os.replace(tmp_path, FIXTURE_PATH)
+
+    return _build(cached['base_url'], cached['signing_seed'], cached['encryption_key'],
+                  cached['link_token'], cached['fetch_token'])
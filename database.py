@@ -1,43 +1,331 @@
 import pymysql
 import os
+import logging
+import base64
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 import hashlib
-import hmac
+import threading
+import time
+import weakref
+import orjson
+from cachetools import TTLCache
+from dbutils.pooled_db import PooledDB, TooManyConnectionsError
+from utils import hash_token, hash_token_bytes, tokens_equal, TOKEN_HASH_PREFIX, TOKEN_MAC_PREFIX, TOKEN_MAC_KEY
+
+logger = logging.getLogger('chicrypt.db')
+
+# Statements are kept as module constants so every call sends the
+# exact same SQL text (PyMySQL has no binary prepared-statement protocol).
+# fetch_token_hash/public_key_hash stay server-side; callers need the key for
+# signature checks and the profile fields for lookups
+SQL_GET_CLIENT = """
+    SELECT id, link_token, public_key, key_type, display_name, created_at
+    FROM clients WHERE link_token = %s
+"""
+SQL_GET_FETCH_TOKEN_HASH = "SELECT fetch_token_hash FROM clients WHERE link_token = %s"
+SQL_UPGRADE_FETCH_TOKEN_HASH = """
+    UPDATE clients SET fetch_token_hash = %s
+    WHERE link_token = %s AND fetch_token_hash = %s
+"""
+SQL_INSERT_MESSAGE = """
+    INSERT INTO messages (link_token, encrypted_message, metadata)
+    VALUES (%s, %s, %s)
+"""
+SQL_INSERT_MESSAGE_SIZED = """
+    INSERT INTO messages (link_token, encrypted_message, metadata, size_bytes)
+    VALUES (%s, %s, %s, %s)
+"""
+SQL_INSERT_CHALLENGE = """
+    INSERT INTO challenges (link_token, challenge_nonce, expires_at)
+    VALUES (%s, %s, DATE_ADD(NOW(), INTERVAL %s SECOND))
+"""
+SQL_INSERT_CHALLENGE_CLIENT_INFO = """
+    INSERT INTO challenges (link_token, challenge_nonce, client_ip, user_agent, expires_at)
+    VALUES (%s, %s, %s, %s, DATE_ADD(NOW(), INTERVAL %s SECOND))
+"""
+SQL_CONSUME_CHALLENGE = """
+    UPDATE challenges SET used = TRUE
+    WHERE link_token = %s AND challenge_nonce = %s
+    AND used = FALSE AND expires_at > NOW()
+    LIMIT 1
+"""
+SQL_INSERT_CLIENT = """
+    INSERT INTO clients (link_token, public_key, public_key_hash, key_type, display_name, fetch_token_hash)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+SQL_GET_CHALLENGE = """
+    SELECT * FROM challenges
+    WHERE link_token = %s AND challenge_nonce = %s
+    AND expires_at > NOW() AND used = FALSE
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+SQL_SUM_USER_STORAGE = """
+    SELECT COALESCE(SUM(size_bytes), 0) AS total, COUNT(*) AS messages
+    FROM messages WHERE link_token = %s
+"""
+SQL_SCHEMA_REVISION = "SELECT version_num FROM alembic_version LIMIT 1"
+SQL_MARK_CHALLENGE_USED = "UPDATE challenges SET used = TRUE WHERE id = %s"
+SQL_DELETE_EXPIRED_CHALLENGES = "DELETE FROM challenges WHERE expires_at < NOW() LIMIT 10000"
+SQL_CLEANUP_EVENT_ACTIVE = """
+    SELECT @@event_scheduler = 'ON' AND EXISTS (
+        SELECT 1 FROM information_schema.EVENTS
+        WHERE EVENT_SCHEMA = DATABASE() AND EVENT_NAME = 'ev_cleanup_challenges'
+        AND STATUS = 'ENABLED'
+    ) AS active
+"""
+SQL_GET_CLIENT_INFO = """
+    SELECT link_token, display_name, created_at
+    FROM clients
+    WHERE link_token = %s
+"""
+# Create-or-reuse in one round trip: uniq_request_pair turns a repeat request
+# into an update, and LAST_INSERT_ID(id) makes lastrowid the existing row's id.
+# An accepted request stays accepted; a rejected one goes back to pending.
+SQL_INSERT_MESSAGE_REQUEST = """
+    INSERT INTO message_requests
+    (from_link_token, to_link_token, from_nickname, status)
+    VALUES (%s, %s, %s, 'pending')
+    ON DUPLICATE KEY UPDATE
+        id = LAST_INSERT_ID(id),
+        status = IF(status = 'accepted', status, 'pending'),
+        from_nickname = VALUES(from_nickname)
+"""
+SQL_GET_PENDING_REQUESTS = """
+    SELECT id, from_link_token, from_nickname, created_at
+    FROM message_requests
+    WHERE to_link_token = %s AND status = 'pending'
+    ORDER BY created_at DESC
+"""
+SQL_UPDATE_REQUEST_STATUS = """
+    UPDATE message_requests
+    SET status = %s, updated_at = NOW()
+    WHERE id = %s
+"""
+SQL_CHECK_MESSAGE_PERMISSION = """
+    SELECT id FROM message_requests
+    WHERE from_link_token = %s
+    AND to_link_token = %s
+    AND status = 'accepted'
+    LIMIT 1
+"""
+SQL_GET_REQUEST = """
+    SELECT id, from_link_token, to_link_token, status
+    FROM message_requests
+    WHERE id = %s
+"""
+
+@lru_cache(maxsize=None)
+def _messages_sql(include_seen, cursor_condition, order, binary=True):
+    """Paginated messages SELECT; only a dozen variants exist, so each is built once"""
+    # Unseen mailboxes are read off idx_messages_unseen (link_token, seen,
+    # created_at); ordering by (created_at, id) lets that index drive the
+    # range scan without a filesort.
+    index_hint = "" if include_seen else "USE INDEX (idx_messages_unseen)"
+    seen_condition = "" if include_seen else "AND seen = FALSE"
+    # Rows are always returned as raw bytes, whatever the storage format
+    payload = "encrypted_message" if binary else "FROM_BASE64(encrypted_message) AS encrypted_message"
+    return f"""
+        SELECT id, {payload},
+               DATE_FORMAT(created_at, '%%Y-%%m-%%dT%%H:%%i:%%s') AS created_at_iso,
+               seen, metadata
+        FROM messages {index_hint}
+        WHERE link_token = %s {seen_condition} {cursor_condition}
+        ORDER BY created_at {order}, id {order}
+        LIMIT %s
+    """
+
+# Upper bound on ids per UPDATE, keeping the statement well under max_allowed_packet
+MARK_SEEN_CHUNK = 1000
+
+@lru_cache(maxsize=None)
+def _mark_seen_sql(count):
+    """UPDATE for count ids; the IN list is a set of primary-key point lookups"""
+    placeholders = ','.join(['%s'] * count)
+    return f"UPDATE messages SET seen = TRUE WHERE id IN ({placeholders}) AND link_token = %s"
+
+def _sha256_hex(value):
+    """SHA-256 hex digest, used for public_key_hash and legacy fetch_token hashes.
+    Not memoized, so plaintext fetch tokens are never held as cache keys.
+    """
+    return hashlib.sha256(value.encode()).hexdigest()
+
+def _parse_token_hash(stored_hash):
+    """
+    Split a stored fetch_token_hash into (scheme, digest, stored_hash)
+    BLAKE2b digests are decoded to raw bytes once; legacy SHA-256 stays hex
+    """
+    for prefix in (TOKEN_MAC_PREFIX, TOKEN_HASH_PREFIX):
+        if stored_hash.startswith(prefix):
+            return prefix, bytes.fromhex(stored_hash[len(prefix):]), stored_hash
+    return '', stored_hash, stored_hash
+
+# How often cleanup_old_challenges re-checks whether the cleanup event is running
+CLEANUP_EVENT_RECHECK_SECONDS = 300
+
+# How often the Alembic revision is re-read to catch migrations applied under a running server
+SCHEMA_RECHECK_SECONDS = 5
+
+class BoundedPooledDB(PooledDB):
+    """PooledDB whose blocking checkout gives up after wait_timeout seconds
+    instead of waiting forever for a connection to be returned
+    """
+    
+    def __init__(self, *args, wait_timeout=None, **kwargs):
+        self._wait_timeout = wait_timeout
+        super().__init__(*args, **kwargs)
+    
+    def _wait_lock(self):
+        if not self._blocking or not self._lock.wait(self._wait_timeout):
+            raise TooManyConnectionsError
 
 class Database:
+    # (table, column) -> column type or None for the schema revision in
+    # _schema_revision; dropped whenever alembic_version moves on, so a
+    # migration run under a live server is picked up within SCHEMA_RECHECK_SECONDS
+    _column_cache = {}
+    _schema_revision = None
+    _schema_checked = None
+    
     def __init__(self):
-        self.connection = None
+        self.pool = None
+        self._finalizer = None
+        # link_token -> parsed fetch_token hash (see _parse_token_hash), so
+        # polling clients skip the SELECT
+        self._fetch_hash_cache = TTLCache(maxsize=4096, ttl=60)
+        self._fetch_hash_lock = threading.RLock()
+        # (from_link_token, to_link_token) pairs known to be accepted; only
+        # positive answers are cached, since accepted requests never revert
+        # and other workers can't invalidate this process's entries
+        self._perm_cache = TTLCache(maxsize=65536, ttl=30)
+        self._perm_lock = threading.RLock()
+        # Whether migration 004's cleanup event is running, re-checked every
+        # CLEANUP_EVENT_RECHECK_SECONDS since it can be created, dropped or
+        # have event_scheduler switched off while the server is up
+        self._cleanup_event_active = None
+        self._cleanup_event_checked = None
+        self._last_cleanup = None
         self.connected = False
         self.connect()
     
     def connect(self):
-        """Establish database connection"""
+        """Create the shared connection pool"""
         try:
-            self.connection = pymysql.connect(
+            connect_args = dict(
                 host=os.getenv('DB_HOST', 'localhost'),
                 user=os.getenv('DB_USER', 'root'),
                 password=os.getenv('DB_PASSWORD', ''),
                 database=os.getenv('DB_NAME', 'pycrypt_db'),
                 charset='utf8mb4',
                 cursorclass=pymysql.cursors.DictCursor,
-                autocommit=True
+                autocommit=True,
+                # Fail fast on a dead or stalled socket instead of hanging a worker
+                connect_timeout=int(os.getenv('DB_CONNECT_TIMEOUT', 5)),
+                read_timeout=int(os.getenv('DB_READ_TIMEOUT', 5)),
+                write_timeout=int(os.getenv('DB_WRITE_TIMEOUT', 5))
             )
+            # Every worker process has its own pool, so by default the
+            # DB_MAX_CONNECTIONS budget (keep it under MySQL's max_connections,
+            # 151 by default) is split across WEB_CONCURRENCY workers
+            workers = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+            budget = int(os.getenv('DB_MAX_CONNECTIONS', 120))
+            max_connections = int(os.getenv('DB_POOL_MAX', max(2, budget // workers)))
+            # Bounded pool shared by every method so concurrent requests
+            # don't serialize on a single socket. ping=1 checks the connection
+            # (and reconnects) whenever it is handed out. mincached opens the
+            # first connection eagerly, so a bad config still fails here.
+            self.pool = BoundedPooledDB(
+                creator=pymysql,
+                mincached=min(int(os.getenv('DB_POOL_MIN', 1)), max_connections),
+                maxcached=min(int(os.getenv('DB_POOL_MAX_IDLE', 20)), max_connections),
+                maxconnections=max_connections,
+                blocking=True,
+                wait_timeout=float(os.getenv('DB_POOL_TIMEOUT', 5)),
+                ping=1,
+                **connect_args
+            )
+            # Safety net for instances that are dropped without close_connection;
+            # holds only the pool, so it doesn't keep self alive
+            self._finalizer = weakref.finalize(self, self.pool.close)
             self.connected = True
-            print("Database connection established successfully")
+            logger.info("Database connection established successfully")
         except Exception as e:
-            print(f"Database connection error: {e}")
-            print("Note: Database connection required for production. Set up MySQL and update .env file.")
+            logger.warning("Database connection error: %s", e)
+            logger.warning("Note: Database connection required for production. Set up MySQL and update .env file.")
             self.connected = False
             # Don't raise exception in development - allow app to start without DB
+
+    @contextmanager
+    def _conn(self):
+        """Check a connection out of the pool and return it when done"""
+        conn = self.pool.connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+    
+    def _check_schema_revision(self, cursor):
+        """Forget probed column types if the Alembic revision has changed"""
+        now = time.monotonic()
+        if Database._schema_checked is not None and now - Database._schema_checked < SCHEMA_RECHECK_SECONDS:
+            return
+        Database._schema_checked = now
+        try:
+            cursor.execute(SQL_SCHEMA_REVISION)
+            rows = cursor.fetchall()
+            revision = rows[0]['version_num'] if rows else None
+        except Exception:
+            # No alembic_version table (schema created by init_database)
+            revision = None
+        if revision != Database._schema_revision:
+            if Database._column_cache:
+                logger.warning("Schema revision changed from %s to %s; re-probing columns",
+                               Database._schema_revision, revision)
+            Database._column_cache.clear()
+            Database._schema_revision = revision
+    
+    def _column_type(self, cursor, table, column):
+        """Return the column's SQL type (lowercase), or None if it doesn't exist.
+        Probed once per column per schema revision.
+        """
+        self._check_schema_revision(cursor)
+        key = (table, column)
+        if key not in Database._column_cache:
+            try:
+                cursor.execute(f"SHOW COLUMNS FROM {table} LIKE %s", (column,))
+                # fetchall so an unbuffered cursor is fully drained
+                rows = cursor.fetchall()
+                col = rows[0] if rows else None
+            except Exception:
+                # Don't remember a failed probe; try again on the next call
+                return None
+            column_type = None
+            if col:
+                column_type = col['Type']
+                if isinstance(column_type, bytes):
+                    column_type = column_type.decode()
+                column_type = column_type.lower()
+            Database._column_cache[key] = column_type
+        return Database._column_cache[key]
+    
+    def _has_column(self, cursor, table, column):
+        """Check whether table has column"""
+        return self._column_type(cursor, table, column) is not None
+    
+    def _binary_messages(self, cursor):
+        """True once migration 008 has turned encrypted_message into LONGBLOB"""
+        return 'blob' in (self._column_type(cursor, 'messages', 'encrypted_message') or '')
     
     def init_database(self):
         """Initialize database tables"""
         if not self.connected:
-            print("Skipping database initialization - no database connection")
+            logger.warning("Skipping database initialization - no database connection")
             return
             
         try:
-            with self.connection.cursor() as cursor:
+            with self._conn() as conn, conn.cursor() as cursor:
                 # Create clients table for simplex link-based chat
                 cursor.execute("""
                     CREATE TABLE IF NOT EXISTS clients (
@@ -59,7 +347,7 @@ class Database:
                     CREATE TABLE IF NOT EXISTS messages (
                         id BIGINT AUTO_INCREMENT PRIMARY KEY,
                         link_token VARCHAR(128) NOT NULL,
-                        encrypted_message LONGTEXT NOT NULL,
+                        encrypted_message LONGBLOB NOT NULL,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         seen BOOLEAN DEFAULT FALSE,
                         metadata JSON NULL,
@@ -67,7 +355,8 @@ class Database:
                         INDEX idx_link_token (link_token),
                         INDEX idx_created_at (created_at),
                         INDEX idx_seen (seen),
-                        INDEX idx_messages_unseen (link_token, seen, created_at)
+                        INDEX idx_messages_unseen (link_token, seen, created_at),
+                        INDEX idx_link_size (link_token, size_bytes)
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
                 """)
                 
@@ -83,7 +372,8 @@ class Database:
                         expires_at TIMESTAMP NOT NULL,
                         used BOOLEAN DEFAULT FALSE,
                         INDEX idx_link_token (link_token),
-                        INDEX idx_expires_at (expires_at)
+                        INDEX idx_expires_at (expires_at),
+                        INDEX idx_challenges_nonce (link_token, challenge_nonce)
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
                 """)
                 
@@ -99,14 +389,16 @@ class Database:
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
                         INDEX idx_to_link_token (to_link_token),
                         INDEX idx_from_link_token (from_link_token),
-                        INDEX idx_status (status)
+                        INDEX idx_status (status),
+                        INDEX idx_requests_pair (from_link_token, to_link_token, status),
+                        UNIQUE KEY uniq_request_pair (from_link_token, to_link_token)
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
                 """)
                 
-            print("Database tables initialized successfully")
+            logger.info("Database tables initialized successfully")
             
         except Exception as e:
-            print(f"Database initialization error: {e}")
+            logger.exception("Database initialization error")
             raise e
     
     def register_client(self, public_key, link_token, fetch_token_hash, display_name=None, key_type='ed25519'):
@@ -115,17 +407,15 @@ class Database:
             raise Exception("Database connection not available")
             
         try:
-            with self.connection.cursor() as cursor:
-                public_key_hash = hashlib.sha256(public_key.encode()).hexdigest()
-                sql = """
-                    INSERT INTO clients (link_token, public_key, public_key_hash, key_type, display_name, fetch_token_hash)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """
-                cursor.execute(sql, (link_token, public_key, public_key_hash, key_type, display_name, fetch_token_hash))
+            with self._conn() as conn, conn.cursor() as cursor:
+                public_key_hash = _sha256_hex(public_key)
+                cursor.execute(SQL_INSERT_CLIENT, (link_token, public_key, public_key_hash, key_type, display_name, fetch_token_hash))
+                with self._fetch_hash_lock:
+                    self._fetch_hash_cache.pop(link_token, None)
                 return cursor.lastrowid
                 
         except Exception as e:
-            print(f"Error registering client: {e}")
+            logger.exception("Error registering client")
             raise e
 
     # Removed context setter; acknowledgment now requires explicit link_token
@@ -136,13 +426,12 @@ class Database:
             return None
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = "SELECT * FROM clients WHERE link_token = %s"
-                cursor.execute(sql, (link_token,))
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_GET_CLIENT, (link_token,))
                 return cursor.fetchone()
                 
-        except Exception as e:
-            print(f"Error getting client by link token: {e}")
+        except Exception:
+            logger.exception("Error getting client by link token")
             return None
     
     def verify_fetch_token(self, link_token, fetch_token):
@@ -150,132 +439,197 @@ class Database:
         if not self.connected:
             return False
         try:
-            with self.connection.cursor() as cursor:
-                sql = "SELECT fetch_token_hash FROM clients WHERE link_token = %s"
-                cursor.execute(sql, (link_token,))
-                result = cursor.fetchone()
+            with self._fetch_hash_lock:
+                cached = self._fetch_hash_cache.get(link_token)
+            if cached is None:
+                with self._conn() as conn, conn.cursor() as cursor:
+                    cursor.execute(SQL_GET_FETCH_TOKEN_HASH, (link_token,))
+                    result = cursor.fetchone()
                 if not result:
                     return False
-                stored_hash = result['fetch_token_hash']
-                provided_hash = hashlib.sha256(fetch_token.encode()).hexdigest()
-                return hmac.compare_digest(stored_hash, provided_hash)
-        except Exception as e:
-            print(f"Error verifying fetch token: {e}")
+                cached = _parse_token_hash(result['fetch_token_hash'])
+                with self._fetch_hash_lock:
+                    self._fetch_hash_cache[link_token] = cached
+            scheme, stored_digest, stored_hash = cached
+            
+            if scheme == TOKEN_MAC_PREFIX:
+                # Keyed hashes can't be checked without the key
+                return bool(TOKEN_MAC_KEY) and tokens_equal(stored_digest, hash_token_bytes(fetch_token))
+            if scheme == TOKEN_HASH_PREFIX:
+                if not tokens_equal(stored_digest, hash_token_bytes(fetch_token, b'')):
+                    return False
+                if not TOKEN_MAC_KEY:
+                    return True
+            elif not tokens_equal(stored_digest, _sha256_hex(fetch_token)):
+                return False
+            
+            # Older scheme (legacy SHA-256, or plain BLAKE2b once a key is
+            # configured): re-hash with the current scheme on first use
+            new_hash = hash_token(fetch_token)
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_UPGRADE_FETCH_TOKEN_HASH, (new_hash, link_token, stored_hash))
+            with self._fetch_hash_lock:
+                self._fetch_hash_cache[link_token] = _parse_token_hash(new_hash)
+            return True
+        except Exception:
+            logger.exception("Error verifying fetch token")
             return False
     
     def store_message(self, link_token, encrypted_message, metadata=None):
-        """Store an encrypted message for a client"""
+        """Store an encrypted message (raw ciphertext bytes) for a client"""
         if not self.connected:
             raise Exception("Database connection not available")
             
         try:
-            with self.connection.cursor() as cursor:
-                import json
-                import base64
+            with self._conn() as conn, conn.cursor() as cursor:
+                metadata_json = orjson.dumps(metadata).decode() if metadata else None
+                size_bytes = len(encrypted_message)
                 
-                metadata_json = json.dumps(metadata) if metadata else None
+                # Schemas before migration 008 still store base64 text
+                if not self._binary_messages(cursor):
+                    encrypted_message = base64.b64encode(encrypted_message).decode()
                 
-                # Calculate size_bytes (decoded message size)
-                try:
-                    size_bytes = len(base64.b64decode(encrypted_message))
-                except Exception:
-                    size_bytes = None
+                has_size_column = self._has_column(cursor, 'messages', 'size_bytes')
                 
-                # Check if size_bytes column exists
-                has_size_column = False
-                try:
-                    cursor.execute("SHOW COLUMNS FROM messages LIKE 'size_bytes'")
-                    col = cursor.fetchone()
-                    if col:
-                        has_size_column = True
-                except Exception:
-                    has_size_column = False
-                
-                if has_size_column and size_bytes is not None:
-                    sql = """
-                        INSERT INTO messages (link_token, encrypted_message, metadata, size_bytes)
-                        VALUES (%s, %s, %s, %s)
-                    """
-                    cursor.execute(sql, (link_token, encrypted_message, metadata_json, size_bytes))
+                if has_size_column:
+                    cursor.execute(SQL_INSERT_MESSAGE_SIZED, (link_token, encrypted_message, metadata_json, size_bytes))
                 else:
-                    sql = """
-                        INSERT INTO messages (link_token, encrypted_message, metadata)
-                        VALUES (%s, %s, %s)
-                    """
-                    cursor.execute(sql, (link_token, encrypted_message, metadata_json))
+                    cursor.execute(SQL_INSERT_MESSAGE, (link_token, encrypted_message, metadata_json))
                 
                 return cursor.lastrowid
                 
         except Exception as e:
-            print(f"Error storing message: {e}")
+            logger.exception("Error storing message")
             raise e
     
-    def get_messages(self, link_token, include_seen=False, limit=50, before_id=None, since_id=None, order='DESC'):
-        """Get messages for a client with pagination.
-        limit: number of messages to return (capped at 200)
-        before_id: return messages with id < before_id (cursor pagination for DESC order)
-        since_id: return messages with id > since_id (cursor pagination for ASC order / polling)
-        order: 'ASC' for chronological (older->newer), 'DESC' for reverse chronological (newer->older)
+    def store_messages_bulk(self, rows):
+        """Store many encrypted messages with one multi-row INSERT.
+        rows: iterable of (link_token, encrypted_message, metadata) tuples,
+        where encrypted_message is the raw ciphertext bytes
         """
         if not self.connected:
-            return []
+            raise Exception("Database connection not available")
             
         try:
-            with self.connection.cursor() as cursor:
-                # Sanitize limit
-                if limit is None or not isinstance(limit, int):
-                    limit = 50
-                limit = max(1, min(limit, 200))
+            with self._conn() as conn, conn.cursor() as cursor:
+                has_size_column = self._has_column(cursor, 'messages', 'size_bytes')
+                binary = self._binary_messages(cursor)
                 
-                # Validate order
-                if order not in ['ASC', 'DESC']:
-                    order = 'DESC'
+                params = []
+                for link_token, encrypted_message, metadata in rows:
+                    metadata_json = orjson.dumps(metadata).decode() if metadata else None
+                    size_bytes = len(encrypted_message)
+                    if not binary:
+                        encrypted_message = base64.b64encode(encrypted_message).decode()
+                    if has_size_column:
+                        params.append((link_token, encrypted_message, metadata_json, size_bytes))
+                    else:
+                        params.append((link_token, encrypted_message, metadata_json))
                 
-                base_condition = "link_token = %s"
-                seen_condition = "" if include_seen else "AND seen = FALSE"
-                cursor_condition = ""
-                params = [link_token]
+                # PyMySQL rewrites executemany on INSERT ... VALUES into one multi-row statement
+                sql = SQL_INSERT_MESSAGE_SIZED if has_size_column else SQL_INSERT_MESSAGE
+                cursor.executemany(sql, params)
+                return cursor.rowcount
                 
-                # Handle cursor pagination
-                if since_id is not None:
-                    # For polling (ASC order typically)
-                    cursor_condition = "AND id > %s"
-                    params.append(since_id)
-                elif before_id is not None:
-                    # For infinite scroll (DESC order typically)
-                    cursor_condition = "AND id < %s"
-                    params.append(before_id)
-                
-                sql = f"""
-                    SELECT id, encrypted_message, created_at, seen, metadata
-                    FROM messages
-                    WHERE {base_condition} {seen_condition} {cursor_condition}
-                    ORDER BY id {order}
-                    LIMIT %s
-                """
-                params.append(limit)
+        except Exception as e:
+            logger.exception("Error storing messages")
+            raise e
+    
+    def _build_messages_query(self, link_token, include_seen, limit, before_id, since_id, order,
+                              before_created_at=None, since_created_at=None, binary=True):
+        """Build the paginated messages SELECT for get_messages"""
+        # Sanitize limit
+        if limit is None or not isinstance(limit, int):
+            limit = 50
+        limit = max(1, min(limit, 200))
+        
+        # Validate order
+        if order not in ['ASC', 'DESC']:
+            order = 'DESC'
+        
+        cursor_condition = ""
+        params = [link_token]
+        
+        # Handle cursor pagination. The composite (created_at, id) keyset is
+        # preferred; a bare id is still accepted from older clients.
+        if since_id is not None:
+            # For polling (ASC order typically)
+            if since_created_at is not None:
+                cursor_condition = "AND (created_at, id) > (%s, %s)"
+                params.extend((since_created_at, since_id))
+            else:
+                cursor_condition = "AND id > %s"
+                params.append(since_id)
+        elif before_id is not None:
+            # For infinite scroll (DESC order typically)
+            if before_created_at is not None:
+                cursor_condition = "AND (created_at, id) < (%s, %s)"
+                params.extend((before_created_at, before_id))
+            else:
+                cursor_condition = "AND id < %s"
+                params.append(before_id)
+        
+        params.append(limit)
+        return _messages_sql(bool(include_seen), cursor_condition, order, binary), params
+    
+    def get_messages(self, link_token, include_seen=False, limit=50, before_id=None, since_id=None, order='DESC',
+                     before_created_at=None, since_created_at=None):
+        """Get messages for a client with keyset pagination on (created_at, id).
+        limit: number of messages to return (capped at 200)
+        before_id/before_created_at: return messages older than this cursor (DESC order)
+        since_id/since_created_at: return messages newer than this cursor (ASC order / polling)
+        order: 'ASC' for chronological (older->newer), 'DESC' for reverse chronological (newer->older)
+        """
+        if not self.connected:
+            return []
+            
+        try:
+            with self._conn() as conn, conn.cursor() as cursor:
+                sql, params = self._build_messages_query(link_token, include_seen, limit, before_id, since_id, order,
+                                                         before_created_at, since_created_at,
+                                                         self._binary_messages(cursor))
                 cursor.execute(sql, params)
                 return cursor.fetchall()
                 
-        except Exception as e:
-            print(f"Error getting messages: {e}")
+        except Exception:
+            logger.exception("Error getting messages")
             return []
     
+    def sum_user_storage(self, link_token):
+        """Total stored ciphertext bytes and message count for a client.
+        Answered from idx_link_size without reading the message bodies.
+        """
+        if not self.connected:
+            return {'total': 0, 'messages': 0}
+            
+        try:
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_SUM_USER_STORAGE, (link_token,))
+                row = cursor.fetchone()
+                return {'total': int(row['total']), 'messages': row['messages']}
+                
+        except Exception:
+            logger.exception("Error summing user storage")
+            return {'total': 0, 'messages': 0}
+    
     def mark_messages_seen(self, link_token, message_ids):
         """Mark messages as seen for given link token (scoped)"""
         if not self.connected:
             raise Exception("Database connection not available")
             
+        if not message_ids:
+            return
+        # Drop duplicates so repeated acks don't grow the statement
+        message_ids = list(dict.fromkeys(message_ids))
+            
         try:
-            with self.connection.cursor() as cursor:
-                if not message_ids:
-                    return
-                placeholders = ','.join(['%s'] * len(message_ids))
-                sql = f"UPDATE messages SET seen = TRUE WHERE id IN ({placeholders}) AND link_token = %s"
-                cursor.execute(sql, (*message_ids, link_token))
+            with self._conn() as conn, conn.cursor() as cursor:
+                for start in range(0, len(message_ids), MARK_SEEN_CHUNK):
+                    chunk = message_ids[start:start + MARK_SEEN_CHUNK]
+                    cursor.execute(_mark_seen_sql(len(chunk)), (*chunk, link_token))
                 
         except Exception as e:
-            print(f"Error marking messages seen: {e}")
+            logger.exception("Error marking messages seen")
             raise e
     
     def create_challenge(self, link_token, challenge_nonce, expires_in_seconds=300, client_ip=None, user_agent=None):
@@ -284,33 +638,18 @@ class Database:
             raise Exception("Database connection not available")
             
         try:
-            with self.connection.cursor() as cursor:
-                # detect if client_ip/user_agent columns exist; fallback if not
-                has_extra_cols = False
-                try:
-                    cursor.execute("SHOW COLUMNS FROM challenges LIKE 'client_ip'")
-                    col = cursor.fetchone()
-                    if col:
-                        has_extra_cols = True
-                except Exception:
-                    has_extra_cols = False
+            with self._conn() as conn, conn.cursor() as cursor:
+                # client_ip/user_agent only exist on newer schemas; fallback if not
+                has_extra_cols = self._has_column(cursor, 'challenges', 'client_ip')
 
                 if has_extra_cols and (client_ip or user_agent):
-                    sql = """
-                        INSERT INTO challenges (link_token, challenge_nonce, client_ip, user_agent, expires_at)
-                        VALUES (%s, %s, %s, %s, DATE_ADD(NOW(), INTERVAL %s SECOND))
-                    """
-                    cursor.execute(sql, (link_token, challenge_nonce, client_ip, user_agent, expires_in_seconds))
+                    cursor.execute(SQL_INSERT_CHALLENGE_CLIENT_INFO, (link_token, challenge_nonce, client_ip, user_agent, expires_in_seconds))
                 else:
-                    sql = """
-                        INSERT INTO challenges (link_token, challenge_nonce, expires_at)
-                        VALUES (%s, %s, DATE_ADD(NOW(), INTERVAL %s SECOND))
-                    """
-                    cursor.execute(sql, (link_token, challenge_nonce, expires_in_seconds))
+                    cursor.execute(SQL_INSERT_CHALLENGE, (link_token, challenge_nonce, expires_in_seconds))
                 return cursor.lastrowid
                 
         except Exception as e:
-            print(f"Error creating challenge: {e}")
+            logger.exception("Error creating challenge")
             raise e
     
     def get_challenge(self, link_token, challenge_nonce):
@@ -319,47 +658,71 @@ class Database:
             return None
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = """
-                    SELECT * FROM challenges
-                    WHERE link_token = %s AND challenge_nonce = %s 
-                    AND expires_at > NOW() AND used = FALSE
-                    ORDER BY created_at DESC
-                    LIMIT 1
-                """
-                cursor.execute(sql, (link_token, challenge_nonce))
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_GET_CHALLENGE, (link_token, challenge_nonce))
                 return cursor.fetchone()
                 
-        except Exception as e:
-            print(f"Error getting challenge: {e}")
+        except Exception:
+            logger.exception("Error getting challenge")
             return None
     
+    def consume_challenge(self, link_token, challenge_nonce):
+        """Atomically mark a valid challenge as used.
+        Returns True only if an unexpired, unused challenge was consumed, so
+        each challenge can authenticate at most one request.
+        """
+        if not self.connected:
+            return False
+
+        try:
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_CONSUME_CHALLENGE, (link_token, challenge_nonce))
+                return cursor.rowcount == 1
+
+        except Exception:
+            logger.exception("Error consuming challenge")
+            return False
+
     def mark_challenge_used(self, challenge_id):
         """Mark a challenge as used"""
         if not self.connected:
             raise Exception("Database connection not available")
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = "UPDATE challenges SET used = TRUE WHERE id = %s"
-                cursor.execute(sql, (challenge_id,))
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_MARK_CHALLENGE_USED, (challenge_id,))
                 
         except Exception as e:
-            print(f"Error marking challenge used: {e}")
+            logger.exception("Error marking challenge used")
             raise e
     
-    def cleanup_old_challenges(self):
-        """Remove expired challenges"""
+    def cleanup_old_challenges(self, min_interval=30):
+        """Remove expired challenges, at most once per min_interval seconds.
+        A no-op when the ev_cleanup_challenges event is doing the purge.
+        """
         if not self.connected:
             return
+        now = time.monotonic()
+        recheck_event = (self._cleanup_event_checked is None
+                         or now - self._cleanup_event_checked >= CLEANUP_EVENT_RECHECK_SECONDS)
+        if self._cleanup_event_active and not recheck_event:
+            return
+        if self._last_cleanup is not None and now - self._last_cleanup < min_interval:
+            return
+        self._last_cleanup = now
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = "DELETE FROM challenges WHERE expires_at < NOW()"
-                cursor.execute(sql)
+            with self._conn() as conn, conn.cursor() as cursor:
+                if recheck_event:
+                    cursor.execute(SQL_CLEANUP_EVENT_ACTIVE)
+                    self._cleanup_event_active = bool(cursor.fetchone()['active'])
+                    self._cleanup_event_checked = now
+                    if self._cleanup_event_active:
+                        return
+                cursor.execute(SQL_DELETE_EXPIRED_CHALLENGES)
                 
-        except Exception as e:
-            print(f"Error cleaning up challenges: {e}")
+        except Exception:
+            logger.exception("Error cleaning up challenges")
     
     def get_client_info_by_link(self, link_token):
         """Get public client info by link token (for checking if contact exists)"""
@@ -367,36 +730,28 @@ class Database:
             return None
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = """
-                    SELECT link_token, display_name, created_at 
-                    FROM clients 
-                    WHERE link_token = %s
-                """
-                cursor.execute(sql, (link_token,))
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_GET_CLIENT_INFO, (link_token,))
                 return cursor.fetchone()
                 
-        except Exception as e:
-            print("Error getting client info: {}".format(e))
+        except Exception:
+            logger.exception("Error getting client info")
             return None
     
     def create_message_request(self, from_link_token, to_link_token, from_nickname):
-        """Create a message request from one client to another"""
+        """Create a message request from one client to another.
+        Returns the request id; repeating a request reuses the existing row.
+        """
         if not self.connected:
             raise Exception("Database connection not available")
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = """
-                    INSERT INTO message_requests 
-                    (from_link_token, to_link_token, from_nickname, status)
-                    VALUES (%s, %s, %s, 'pending')
-                """
-                cursor.execute(sql, (from_link_token, to_link_token, from_nickname))
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_INSERT_MESSAGE_REQUEST, (from_link_token, to_link_token, from_nickname))
                 return cursor.lastrowid
                 
         except Exception as e:
-            print("Error creating message request: {}".format(e))
+            logger.exception("Error creating message request")
             raise e
     
     def get_pending_requests(self, to_link_token):
@@ -405,18 +760,12 @@ class Database:
             return []
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = """
-                    SELECT id, from_link_token, from_nickname, created_at
-                    FROM message_requests
-                    WHERE to_link_token = %s AND status = 'pending'
-                    ORDER BY created_at DESC
-                """
-                cursor.execute(sql, (to_link_token,))
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_GET_PENDING_REQUESTS, (to_link_token,))
                 return cursor.fetchall()
                 
-        except Exception as e:
-            print("Error getting pending requests: {}".format(e))
+        except Exception:
+            logger.exception("Error getting pending requests")
             return []
     
     def update_request_status(self, request_id, status):
@@ -425,38 +774,40 @@ class Database:
             raise Exception("Database connection not available")
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = """
-                    UPDATE message_requests 
-                    SET status = %s, updated_at = NOW()
-                    WHERE id = %s
-                """
-                cursor.execute(sql, (status, request_id))
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_GET_REQUEST, (request_id,))
+                req = cursor.fetchone()
+                cursor.execute(SQL_UPDATE_REQUEST_STATUS, (status, request_id))
+                if req:
+                    with self._perm_lock:
+                        self._perm_cache.pop((req['from_link_token'], req['to_link_token']), None)
                 
         except Exception as e:
-            print("Error updating request status: {}".format(e))
+            logger.exception("Error updating request status")
             raise e
     
     def check_message_permission(self, from_link_token, to_link_token):
         """Check if from_client has permission to message to_client"""
         if not self.connected:
             return False
+        
+        key = (from_link_token, to_link_token)
+        with self._perm_lock:
+            if key in self._perm_cache:
+                return True
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = """
-                    SELECT id FROM message_requests
-                    WHERE from_link_token = %s 
-                    AND to_link_token = %s 
-                    AND status = 'accepted'
-                    LIMIT 1
-                """
-                cursor.execute(sql, (from_link_token, to_link_token))
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_CHECK_MESSAGE_PERMISSION, (from_link_token, to_link_token))
                 result = cursor.fetchone()
-                return result is not None
+            if result is None:
+                return False
+            with self._perm_lock:
+                self._perm_cache[key] = True
+            return True
                 
-        except Exception as e:
-            print("Error checking message permission: {}".format(e))
+        except Exception:
+            logger.exception("Error checking message permission")
             return False
     
     def get_request_by_id(self, request_id):
@@ -465,23 +816,22 @@ class Database:
             return None
             
         try:
-            with self.connection.cursor() as cursor:
-                sql = """
-                    SELECT * FROM message_requests
-                    WHERE id = %s
-                """
-                cursor.execute(sql, (request_id,))
+            with self._conn() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_GET_REQUEST, (request_id,))
                 return cursor.fetchone()
                 
-        except Exception as e:
-            print("Error getting request: {}".format(e))
+        except Exception:
+            logger.exception("Error getting request")
             return None
     
     def close_connection(self):
-        """Close database connection"""
-        if self.connection:
-            self.connection.close()
+        """Close all pooled connections (safe to call more than once)"""
+        if self._finalizer:
+            self._finalizer()
+        self.connected = False
+    
+    def __enter__(self):
+        return self
     
-    def __del__(self):
-        """Cleanup on object destruction"""
+    def __exit__(self, exc_type, exc_value, traceback):
         self.close_connection()
\ No newline at end of file
@@ -0,0 +1,19 @@
+"""Gunicorn configuration for the ChiCrypt server
+
+Run with: gunicorn app:app
+Apply database migrations first with: flask --app app migrate
+"""
+import multiprocessing
+import os
+
+bind = "0.0.0.0:{}".format(os.environ.get('PORT', 5000))
+
+# gevent workers: the endpoints are I/O-bound on MySQL, so each worker can
+# keep many requests in flight while PyMySQL (pure Python) is monkey-patched.
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Workers inherit this and size their database pools from it (see DB_MAX_CONNECTIONS)
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_connections = 1000
+
+loglevel = os.environ.get('LOG_LEVEL', 'info').lower()
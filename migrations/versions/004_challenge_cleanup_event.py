@@ -0,0 +1,43 @@
+"""Purge expired challenges with a scheduled event
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-15
+
+"""
+import logging
+
+from alembic import op
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+# revision identifiers, used by Alembic.
+revision = '004'
+down_revision = '003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create an event that deletes expired challenges every minute"""
+    
+    # Requires the EVENT privilege; the server's event_scheduler must be ON
+    # for it to fire. The app falls back to its own cleanup task otherwise,
+    # so a host without the privilege (e.g. shared cPanel accounts) skips it
+    # rather than blocking the later migrations.
+    try:
+        op.execute("""
+            CREATE EVENT IF NOT EXISTS ev_cleanup_challenges
+            ON SCHEDULE EVERY 60 SECOND
+            DO DELETE FROM challenges WHERE expires_at < NOW() LIMIT 10000
+        """)
+    except DBAPIError as e:
+        logger.warning("Could not create ev_cleanup_challenges, the app will purge "
+                       "expired challenges itself: %s", e.orig)
+
+
+def downgrade():
+    """Drop the challenge cleanup event"""
+    
+    op.execute("DROP EVENT IF EXISTS ev_cleanup_challenges")
@@ -0,0 +1,31 @@
+"""Add composite index for message permission checks
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Add covering index for check_message_permission"""
+    
+    # (from, to, status) answers the permission lookup from the index alone
+    op.create_index(
+        'idx_requests_pair',
+        'message_requests',
+        ['from_link_token', 'to_link_token', 'status']
+    )
+
+
+def downgrade():
+    """Remove the permission index"""
+    
+    op.drop_index('idx_requests_pair', table_name='message_requests')
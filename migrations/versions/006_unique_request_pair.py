@@ -0,0 +1,40 @@
+"""Make message requests unique per sender/recipient pair
+
+Revision ID: 006
+Revises: 005
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '006'
+down_revision = '005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Collapse duplicate requests and add a unique (from, to) key"""
+    
+    # Keep one row per pair: an accepted one if any, otherwise the newest
+    op.execute("""
+        DELETE r1 FROM message_requests r1
+        JOIN message_requests r2
+          ON r1.from_link_token = r2.from_link_token
+         AND r1.to_link_token = r2.to_link_token
+         AND ((r2.status = 'accepted') > (r1.status = 'accepted')
+              OR ((r2.status = 'accepted') = (r1.status = 'accepted') AND r2.id > r1.id))
+    """)
+    
+    op.create_unique_constraint(
+        'uniq_request_pair',
+        'message_requests',
+        ['from_link_token', 'to_link_token']
+    )
+
+
+def downgrade():
+    """Remove the unique (from, to) key"""
+    
+    op.drop_constraint('uniq_request_pair', 'message_requests', type_='unique')
@@ -0,0 +1,32 @@
+"""Add composite index for challenge consumption
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '007'
+down_revision = '006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Index challenges by (link_token, challenge_nonce)"""
+    
+    # Turns consume_challenge's UPDATE into a point lookup instead of a scan
+    # over every challenge issued to the link
+    op.create_index(
+        'idx_challenges_nonce',
+        'challenges',
+        ['link_token', 'challenge_nonce']
+    )
+
+
+def downgrade():
+    """Remove the challenge nonce index"""
+    
+    op.drop_index('idx_challenges_nonce', table_name='challenges')
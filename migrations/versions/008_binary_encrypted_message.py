@@ -0,0 +1,46 @@
+"""Store encrypted messages as raw bytes
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '008'
+down_revision = '007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Convert encrypted_message from base64 LONGTEXT to raw LONGBLOB"""
+    
+    # The base64 text carries over byte-for-byte, then is decoded in place
+    # (25% smaller rows). Rows that aren't valid base64 are left as they are;
+    # they were unreadable before (FROM_BASE64 returned NULL on read) and are
+    # now returned as their stored bytes.
+    #
+    # Running servers notice the new column type within a few seconds (see
+    # Database._check_schema_revision). Messages a worker writes as base64 in
+    # that window, after the UPDATE below, stay base64 text inside the BLOB,
+    # so stop or restart the workers around this migration.
+    op.execute("ALTER TABLE messages MODIFY encrypted_message LONGBLOB NOT NULL")
+    op.execute("""
+        UPDATE messages SET encrypted_message = FROM_BASE64(encrypted_message)
+        WHERE FROM_BASE64(encrypted_message) IS NOT NULL
+    """)
+
+
+def downgrade():
+    """Convert encrypted_message back to base64 LONGTEXT"""
+    
+    # TO_BASE64 wraps its output every 76 characters; strip the newlines
+    op.execute("""
+        UPDATE messages SET encrypted_message = REPLACE(TO_BASE64(encrypted_message), '\\n', '')
+    """)
+    op.execute("""
+        ALTER TABLE messages MODIFY encrypted_message LONGTEXT
+        CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL
+    """)
@@ -0,0 +1,37 @@
+"""Backfill size_bytes and index it for storage totals
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '009'
+down_revision = '008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Fill size_bytes for older rows and add a (link_token, size_bytes) index"""
+    
+    # encrypted_message holds raw bytes since 008, so its length is the size
+    op.execute("""
+        UPDATE messages SET size_bytes = OCTET_LENGTH(encrypted_message)
+        WHERE size_bytes IS NULL
+    """)
+    
+    # Lets per-link storage totals be summed from the index alone
+    op.create_index(
+        'idx_link_size',
+        'messages',
+        ['link_token', 'size_bytes']
+    )
+
+
+def downgrade():
+    """Remove the size index (backfilled values are kept)"""
+    
+    op.drop_index('idx_link_size', table_name='messages')
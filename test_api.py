@@ -1,15 +1,14 @@
 #!/usr/bin/env python3
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519
 from cryptography.hazmat.primitives import serialization
 
-# Generate test RSA key pair
-private_key = rsa.generate_private_key(
-    public_exponent=65537,
-    key_size=2048,
-)
+# Generate test Ed25519 key pair (the server's default key type, and far
+# cheaper to generate than RSA-2048)
+private_key = ed25519.Ed25519PrivateKey.generate()
 
 public_key = private_key.public_key()
 public_pem = public_key.public_bytes(
@@ -17,6 +16,10 @@ public_pem = public_key.public_bytes(
     format=serialization.PublicFormat.SubjectPublicKeyInfo
 ).decode('utf-8')
 
+# One keep-alive session for every call instead of a new connection each time
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
 print("Generated Public Key:")
 print(public_pem)
 print("\n" + "="*50 + "\n")
@@ -24,7 +27,7 @@ print("\n" + "="*50 + "\n")
 # Test 1: Health Check
 print("1. Testing Health Check...")
 try:
-    response = requests.get('http://localhost:5000/health')
+    response = session.get('http://localhost:5000/health')
     print(f"Status: {response.status_code}")
     print(f"Response: {response.json()}")
 except Exception as e:
@@ -36,7 +39,7 @@ print("\n" + "="*50 + "\n")
 print("2. Testing Client Registration...")
 try:
     payload = {"public_key": public_pem}
-    response = requests.post('http://localhost:5000/register_client', json=payload)
+    response = session.post('http://localhost:5000/register_client', json=payload)
     print(f"Status: {response.status_code}")
     registration_data = response.json()
     print(f"Response: {registration_data}")
@@ -55,7 +58,7 @@ try:
             "encrypted_data": encrypted_test_data
         }
         
-        response = requests.post('http://localhost:5000/store_data', json=payload)
+        response = session.post('http://localhost:5000/store_data', json=payload)
         print(f"Status: {response.status_code}")
         print(f"Response: {response.json()}")
         
@@ -64,7 +67,7 @@ try:
         print("4. Testing Get Data by Public Key...")
         
         payload = {"public_key": public_pem}
-        response = requests.post('http://localhost:5000/get_data', json=payload)
+        response = session.post('http://localhost:5000/get_data', json=payload)
         print(f"Status: {response.status_code}")
         print(f"Response: {response.json()}")
         
@@ -73,7 +76,7 @@ try:
         print("5. Testing Get Data by Secure Link...")
         
         payload = {"secure_link": secure_link}
-        response = requests.post('http://localhost:5000/get_data_by_link', json=payload)
+        response = session.post('http://localhost:5000/get_data_by_link', json=payload)
         print(f"Status: {response.status_code}")
         print(f"Response: {response.json()}")
         
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Unit tests for Database methods that don't need a MySQL server
+Connections come from a fake pool that records every statement, so these run
+without the API server or a database.
+"""
+
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import pytest
+from cachetools import TTLCache
+
+import database
+from database import Database, SQL_GET_FETCH_TOKEN_HASH, SQL_UPGRADE_FETCH_TOKEN_HASH
+from utils import hash_token, TOKEN_HASH_PREFIX
+
+class FakeCursor:
+    def __init__(self, rows, executed):
+        self._rows = rows
+        self._executed = executed
+        self._result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=()):
+        self._executed.append((sql, params))
+        self._result = self._rows.get(sql)
+
+    def fetchone(self):
+        return self._result
+
+class FakeConnection:
+    def __init__(self, rows, executed):
+        self._rows = rows
+        self._executed = executed
+
+    def cursor(self, *args):
+        return FakeCursor(self._rows, self._executed)
+
+def make_db(stored_hash):
+    """Database wired to a fake connection whose clients row holds stored_hash"""
+    db = Database.__new__(Database)
+    db.connected = True
+    db._fetch_hash_cache = TTLCache(maxsize=16, ttl=60)
+    db._fetch_hash_lock = threading.RLock()
+    db.executed = []
+    rows = {SQL_GET_FETCH_TOKEN_HASH: {'fetch_token_hash': stored_hash}}
+
+    @contextmanager
+    def fake_conn():
+        yield FakeConnection(rows, db.executed)
+
+    db._conn = fake_conn
+    return db
+
+@pytest.fixture(autouse=True)
+def unkeyed():
+    # The expected hashes below are the unkeyed BLAKE2b scheme
+    if database.TOKEN_MAC_KEY:
+        pytest.skip("TOKEN_MAC_KEY is set")
+
+def test_legacy_sha256_hash_upgraded_on_use():
+    legacy_hash = hashlib.sha256(b'fetch-token').hexdigest()
+    db = make_db(legacy_hash)
+
+    assert db.verify_fetch_token('link_a', 'fetch-token')
+
+    sql, params = db.executed[-1]
+    assert sql == SQL_UPGRADE_FETCH_TOKEN_HASH
+    new_hash, link_token, expected_old = params
+    assert new_hash.startswith(TOKEN_HASH_PREFIX)
+    assert (link_token, expected_old) == ('link_a', legacy_hash)
+    # Later checks use the upgraded hash from the cache, without a query
+    executed = len(db.executed)
+    assert db.verify_fetch_token('link_a', 'fetch-token')
+    assert len(db.executed) == executed
+
+def test_legacy_hash_not_upgraded_on_wrong_token():
+    db = make_db(hashlib.sha256(b'fetch-token').hexdigest())
+
+    assert not db.verify_fetch_token('link_a', 'wrong-token')
+    assert all(sql != SQL_UPGRADE_FETCH_TOKEN_HASH for sql, _ in db.executed)
+
+def test_current_hash_not_rewritten():
+    db = make_db(hash_token('fetch-token'))
+
+    assert db.verify_fetch_token('link_a', 'fetch-token')
+    assert all(sql != SQL_UPGRADE_FETCH_TOKEN_HASH for sql, _ in db.executed)
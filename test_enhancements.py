@@ -8,21 +8,30 @@ Tests:
 4. Key type validation
 """
 
-import requests
-import json
-import base64
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from nacl.public import PrivateKey, PublicKey, SealedBox
 from nacl.signing import SigningKey
 from nacl.encoding import Base64Encoder
+from conftest_fixtures import b64e, report, section, post, FAKE_CT_B64
 
 BASE_URL = 'http://localhost:5000'
 
-print("="*70)
-print("SECURITY AND PAGINATION FEATURES TEST")
-print("="*70)
+# Encryption keys and a reusable ciphertext for tests that only need a valid
+# message; encrypting is done once instead of per test
+encryption_private_key = PrivateKey.generate()
+SEALED_BOX = SealedBox(encryption_private_key.public_key)
+NORMAL_CIPHERTEXT_B64 = b64e(SEALED_BOX.encrypt(b"Normal sized message"))
+
+# Oversized plaintext (20KB), built as bytes once at import
+LARGE_BYTES = b"A" * 20000
+
+report("="*70)
+report("SECURITY AND PAGINATION FEATURES TEST")
+report("="*70)
 
 # Test 1: Input Sanitization in Registration
-print("\n1. Testing Input Sanitization in Registration...")
+section("1. Testing Input Sanitization in Registration...")
 signing_key = SigningKey.generate()
 verify_key = signing_key.verify_key
 public_key_b64 = verify_key.encode(encoder=Base64Encoder).decode('utf-8')
@@ -34,21 +43,21 @@ registration_data = {
     "display_name": malicious_name
 }
 
-response = requests.post(f'{BASE_URL}/register', json=registration_data)
-print(f"   Status: {response.status_code}")
+response = post(f'{BASE_URL}/register', registration_data)
+report(f"   Status: {response.status_code}")
 
 if response.status_code == 201:
-    reg_result = response.json()
-    print(f"   ✓ Registration successful")
-    print(f"   Display name sanitized (should be clean)")
+    reg_result = orjson.loads(response.content)
+    report(f"   ✓ Registration successful")
+    report(f"   Display name sanitized (should be clean)")
     link_token = reg_result['link_token']
     fetch_token = reg_result['fetch_token']
 else:
-    print(f"   ✗ Registration failed: {response.json()}")
+    report(f"   ✗ Registration failed: {orjson.loads(response.content)}")
     exit(1)
 
 # Test 2: Key Type Validation
-print("\n2. Testing Key Type Validation...")
+section("2. Testing Key Type Validation...")
 signing_key2 = SigningKey.generate()
 verify_key2 = signing_key2.verify_key
 public_key2_b64 = verify_key2.encode(encoder=Base64Encoder).decode('utf-8')
@@ -60,107 +69,97 @@ registration_data2 = {
     "key_type": "rsa"  # Unsupported
 }
 
-response = requests.post(f'{BASE_URL}/register', json=registration_data2)
-print(f"   Status: {response.status_code}")
+response = post(f'{BASE_URL}/register', registration_data2)
+report(f"   Status: {response.status_code}")
 
 if response.status_code == 400:
-    print(f"   ✓ Correctly rejected unsupported key_type")
-    print(f"   Error: {response.json()['error']}")
+    report(f"   ✓ Correctly rejected unsupported key_type")
+    report(f"   Error: {orjson.loads(response.content)['error']}")
 else:
-    print(f"   ✗ Should have rejected unsupported key_type")
+    report(f"   ✗ Should have rejected unsupported key_type")
 
 # Register with valid key_type
 registration_data2['key_type'] = 'ed25519'
-response = requests.post(f'{BASE_URL}/register', json=registration_data2)
+response = post(f'{BASE_URL}/register', registration_data2)
 if response.status_code == 201:
-    print(f"   ✓ Accepted valid key_type (ed25519)")
-    reg_result2 = response.json()
+    report(f"   ✓ Accepted valid key_type (ed25519)")
+    reg_result2 = orjson.loads(response.content)
     if 'key_type' in reg_result2:
-        print(f"   ✓ Response includes key_type: {reg_result2['key_type']}")
+        report(f"   ✓ Response includes key_type: {reg_result2['key_type']}")
 else:
-    print(f"   ✗ Failed to register with valid key_type")
+    report(f"   ✗ Failed to register with valid key_type")
 
 # Test 3: Message Size Validation
-print("\n3. Testing Message Size Limits...")
-encryption_private_key = PrivateKey.generate()
-encryption_public_key = encryption_private_key.public_key
-sealed_box = SealedBox(encryption_public_key)
-
+section("3. Testing Message Size Limits...")
 # Try to send a message that's too large (> 16KB when decoded)
-large_plaintext = "A" * 20000  # 20KB
-encrypted_large = sealed_box.encrypt(large_plaintext.encode('utf-8'))
-encrypted_large_b64 = base64.b64encode(encrypted_large).decode('utf-8')
+encrypted_large = SEALED_BOX.encrypt(LARGE_BYTES)
+encrypted_large_b64 = b64e(encrypted_large)
 
 send_data = {
     "link_token": link_token,
     "encrypted_message": encrypted_large_b64
 }
 
-response = requests.post(f'{BASE_URL}/send', json=send_data)
-print(f"   Status: {response.status_code}")
+response = post(f'{BASE_URL}/send', send_data)
+report(f"   Status: {response.status_code}")
 
 if response.status_code == 413:
-    print(f"   ✓ Correctly rejected oversized message")
-    print(f"   Error: {response.json()['error']}")
+    report(f"   ✓ Correctly rejected oversized message")
+    report(f"   Error: {orjson.loads(response.content)['error']}")
 else:
-    print(f"   ✗ Should have rejected oversized message (got {response.status_code})")
+    report(f"   ✗ Should have rejected oversized message (got {response.status_code})")
 
 # Send a normal-sized message
-normal_plaintext = "Normal sized message"
-encrypted_normal = sealed_box.encrypt(normal_plaintext.encode('utf-8'))
-encrypted_normal_b64 = base64.b64encode(encrypted_normal).decode('utf-8')
-
 send_data = {
     "link_token": link_token,
-    "encrypted_message": encrypted_normal_b64
+    "encrypted_message": NORMAL_CIPHERTEXT_B64
 }
 
-response = requests.post(f'{BASE_URL}/send', json=send_data)
+response = post(f'{BASE_URL}/send', send_data)
 if response.status_code == 201:
-    print(f"   ✓ Normal sized message accepted")
-    msg_id_1 = response.json()['id']
+    report(f"   ✓ Normal sized message accepted")
+    msg_id_1 = orjson.loads(response.content)['id']
 else:
-    print(f"   ✗ Failed to send normal message")
+    report(f"   ✗ Failed to send normal message")
     msg_id_1 = None
 
 # Test 4: Metadata Size Validation
-print("\n4. Testing Metadata Size Limits...")
+section("4. Testing Metadata Size Limits...")
 large_metadata = {"data": "X" * 5000}  # > 4KB
 send_data = {
     "link_token": link_token,
-    "encrypted_message": encrypted_normal_b64,
+    "encrypted_message": FAKE_CT_B64,
     "metadata": large_metadata
 }
 
-response = requests.post(f'{BASE_URL}/send', json=send_data)
-print(f"   Status: {response.status_code}")
+response = post(f'{BASE_URL}/send', send_data)
+report(f"   Status: {response.status_code}")
 
 if response.status_code == 413:
-    print(f"   ✓ Correctly rejected oversized metadata")
-    print(f"   Error: {response.json()['error']}")
+    report(f"   ✓ Correctly rejected oversized metadata")
+    report(f"   Error: {orjson.loads(response.content)['error']}")
 else:
-    print(f"   ✗ Should have rejected oversized metadata (got {response.status_code})")
+    report(f"   ✗ Should have rejected oversized metadata (got {response.status_code})")
 
 # Test 5: Pagination with since_id
-print("\n5. Testing Pagination Features...")
-
-# Send multiple messages
-message_ids = []
-for i in range(5):
-    plaintext = f"Message {i+1}"
-    encrypted = sealed_box.encrypt(plaintext.encode('utf-8'))
-    encrypted_b64 = base64.b64encode(encrypted).decode('utf-8')
-    
-    send_data = {
+section("5. Testing Pagination Features...")
+
+# Send multiple messages concurrently (payloads are built up front)
+payloads = [
+    {
         "link_token": link_token,
-        "encrypted_message": encrypted_b64
+        "encrypted_message": b64e(SEALED_BOX.encrypt(f"Message {i+1}".encode('utf-8')))
     }
-    
-    response = requests.post(f'{BASE_URL}/send', json=send_data)
-    if response.status_code == 201:
-        message_ids.append(response.json()['id'])
+    for i in range(5)
+]
+
+with ThreadPoolExecutor(max_workers=5) as executor:
+    responses = list(executor.map(lambda p: post(f'{BASE_URL}/send', p), payloads))
+
+# Ids follow arrival order at the server, so sort them for the cursor tests
+message_ids = sorted(orjson.loads(r.content)['id'] for r in responses if r.status_code == 201)
 
-print(f"   Sent {len(message_ids)} messages")
+report(f"   Sent {len(message_ids)} messages")
 
 # Fetch with DESC order (default)
 headers = {"Authorization": f"Bearer {fetch_token}"}
@@ -169,13 +168,13 @@ fetch_data = {
     "limit": 3
 }
 
-response = requests.post(f'{BASE_URL}/fetch', json=fetch_data, headers=headers)
+response = post(f'{BASE_URL}/fetch', fetch_data, headers=headers)
 if response.status_code == 200:
-    result = response.json()
-    print(f"   ✓ Fetched {result['count']} messages (DESC order)")
-    print(f"   Has more: {result['has_more']}")
+    result = orjson.loads(response.content)
+    report(f"   ✓ Fetched {result['count']} messages (DESC order)")
+    report(f"   Has more: {result['has_more']}")
     if 'next_cursor' in result:
-        print(f"   Next cursor: {result['next_cursor']}")
+        report(f"   Next cursor: {result['next_cursor']}")
 
 # Fetch with ASC order
 fetch_data = {
@@ -184,17 +183,17 @@ fetch_data = {
     "order": "ASC"
 }
 
-response = requests.post(f'{BASE_URL}/fetch', json=fetch_data, headers=headers)
+response = post(f'{BASE_URL}/fetch', fetch_data, headers=headers)
 if response.status_code == 200:
-    result = response.json()
-    print(f"   ✓ Fetched {result['count']} messages (ASC order)")
+    result = orjson.loads(response.content)
+    report(f"   ✓ Fetched {result['count']} messages (ASC order)")
     messages_asc = result['data']
     if len(messages_asc) > 1:
         # Verify ascending order
         if messages_asc[0]['id'] < messages_asc[-1]['id']:
-            print(f"   ✓ Messages are in ascending order")
+            report(f"   ✓ Messages are in ascending order")
         else:
-            print(f"   ✗ Messages not in ascending order")
+            report(f"   ✗ Messages not in ascending order")
 
 # Test since_id pagination
 if message_ids:
@@ -204,16 +203,16 @@ if message_ids:
         "order": "ASC"
     }
     
-    response = requests.post(f'{BASE_URL}/fetch', json=fetch_data, headers=headers)
+    response = post(f'{BASE_URL}/fetch', fetch_data, headers=headers)
     if response.status_code == 200:
-        result = response.json()
-        print(f"   ✓ Fetched {result['count']} messages since_id={message_ids[2]}")
+        result = orjson.loads(response.content)
+        report(f"   ✓ Fetched {result['count']} messages since_id={message_ids[2]}")
         # All messages should have id > since_id
         all_after = all(msg['id'] > message_ids[2] for msg in result['data'])
         if all_after:
-            print(f"   ✓ All messages are after since_id")
+            report(f"   ✓ All messages are after since_id")
         else:
-            print(f"   ✗ Some messages are not after since_id")
+            report(f"   ✗ Some messages are not after since_id")
 
 # Test before_id pagination
 fetch_data = {
@@ -223,27 +222,27 @@ fetch_data = {
     "order": "DESC"
 }
 
-response = requests.post(f'{BASE_URL}/fetch', json=fetch_data, headers=headers)
+response = post(f'{BASE_URL}/fetch', fetch_data, headers=headers)
 if response.status_code == 200:
-    result = response.json()
-    print(f"   ✓ Fetched {result['count']} messages before_id={message_ids[-1]}")
+    result = orjson.loads(response.content)
+    report(f"   ✓ Fetched {result['count']} messages before_id={message_ids[-1]}")
     # All messages should have id < before_id
     all_before = all(msg['id'] < message_ids[-1] for msg in result['data'])
     if all_before:
-        print(f"   ✓ All messages are before before_id")
+        report(f"   ✓ All messages are before before_id")
     else:
-        print(f"   ✗ Some messages are not before before_id")
-
-print("\n" + "="*70)
-print("SECURITY AND PAGINATION TESTS COMPLETED")
-print("="*70)
-print("\nSummary:")
-print("✓ Input sanitization for display_name")
-print("✓ Key type validation (only ed25519)")
-print("✓ Message size limits (max 16KB)")
-print("✓ Metadata size limits (max 4KB)")
-print("✓ Pagination with ASC/DESC order")
-print("✓ Pagination with since_id (polling)")
-print("✓ Pagination with before_id (infinite scroll)")
-print("✓ Pagination metadata (count, has_more, next_cursor)")
-print("="*70)
+        report(f"   ✗ Some messages are not before before_id")
+
+report("\n" + "="*70)
+report("SECURITY AND PAGINATION TESTS COMPLETED")
+report("="*70)
+report("\nSummary:")
+report("✓ Input sanitization for display_name")
+report("✓ Key type validation (only ed25519)")
+report("✓ Message size limits (max 16KB)")
+report("✓ Metadata size limits (max 4KB)")
+report("✓ Pagination with ASC/DESC order")
+report("✓ Pagination with since_id (polling)")
+report("✓ Pagination with before_id (infinite scroll)")
+report("✓ Pagination metadata (count, has_more, next_cursor)")
+report("="*70)
@@ -3,157 +3,173 @@
 Test script for new permission-based messaging endpoints
 """
 
+import os
+import pytest
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from nacl.signing import SigningKey
 from nacl.public import PrivateKey, SealedBox
 from nacl.encoding import Base64Encoder
+from conftest_fixtures import TIMEOUT
 
 # Server URL
-BASE_URL = "http://localhost:5000"
+BASE_URL = os.environ.get('TEST_BASE_URL', "http://localhost:5000")
+
+# Under pytest, skip instead of failing when the server is down (see conftest.py)
+pytestmark = pytest.mark.usefixtures('server_available')
+
+def run_batch(session, *steps):
+    """
+    Run (path, body[, headers]) steps in one /batch request
+    Returns one (status, body) tuple per step, in order
+    """
+    pipeline = [
+        {'path': path, 'body': body, 'headers': headers[0] if headers else {}}
+        for path, body, *headers in steps
+    ]
+    response = session.post(f"{BASE_URL}/batch", json={'pipeline': pipeline}, timeout=TIMEOUT)
+    response.raise_for_status()
+    return [(result['status'], result['body']) for result in response.json()['results']]
 
 def test_permission_workflow():
     """Test the complete permission-based messaging workflow"""
     
-    print("\n=== Testing Permission-Based Messaging Workflow ===\n")
-    
-    # Step 1: Create two clients (Alice and Bob)
-    print("Step 1: Registering two clients (Alice and Bob)...")
-    
-    # Alice's keys
-    alice_signing_key = SigningKey.generate()
-    alice_public_key_b64 = base64.b64encode(bytes(alice_signing_key.verify_key)).decode()
-    
-    response = requests.post(f"{BASE_URL}/register", json={
-        'public_key': alice_public_key_b64,
-        'display_name': 'Alice'
-    })
-    alice_data = response.json()
-    alice_link_token = alice_data['link_token']
-    alice_fetch_token = alice_data['fetch_token']
-    print(f"✓ Alice registered: {alice_link_token}")
-    
-    # Bob's keys
-    bob_signing_key = SigningKey.generate()
-    bob_public_key_b64 = base64.b64encode(bytes(bob_signing_key.verify_key)).decode()
-    
-    response = requests.post(f"{BASE_URL}/register", json={
-        'public_key': bob_public_key_b64,
-        'display_name': 'Bob'
-    })
-    bob_data = response.json()
-    bob_link_token = bob_data['link_token']
-    bob_fetch_token = bob_data['fetch_token']
-    print(f"✓ Bob registered: {bob_link_token}")
-    
-    # Step 2: Bob checks if Alice exists
-    print("\nStep 2: Bob checking if Alice's contact exists...")
-    response = requests.post(f"{BASE_URL}/check_contact", json={
-        'link_token': alice_link_token
-    })
-    contact_info = response.json()
-    print(f"✓ Contact exists: {contact_info['exists']}")
-    print(f"  Nickname: {contact_info.get('nickname')}")
-    
-    # Step 3: Bob requests permission to message Alice
-    print("\nStep 3: Bob requesting permission to message Alice...")
-    response = requests.post(f"{BASE_URL}/request_message_permission", json={
-        'from_link_token': bob_link_token,
-        'to_link_token': alice_link_token,
-        'from_nickname': 'Bob'
-    })
-    request_data = response.json()
-    request_id = request_data['request_id']
-    print(f"✓ Permission request sent: Request ID {request_id}")
-    
-    # Step 4: Alice fetches her message requests
-    print("\nStep 4: Alice fetching message requests...")
-    response = requests.post(f"{BASE_URL}/get_message_requests", 
-        json={'link_token': alice_link_token},
-        headers={'Authorization': f'Bearer {alice_fetch_token}'}
-    )
-    requests_data = response.json()
-    print(f"✓ Found {len(requests_data['data'])} pending request(s)")
-    for req in requests_data['data']:
-        print(f"  From: {req['from_nickname']} ({req['from_link_token']})")
-    
-    # Step 5: Alice accepts Bob's request
-    print("\nStep 5: Alice accepting Bob's request...")
-    response = requests.post(f"{BASE_URL}/respond_message_request", 
-        json={
-            'link_token': alice_link_token,
-            'request_id': request_id,
-            'action': 'accept'
-        },
-        headers={'Authorization': f'Bearer {alice_fetch_token}'}
-    )
-    accept_data = response.json()
-    print(f"✓ Request {accept_data['status']}")
-    
-    # Step 6: Bob tries to send message to Alice (should succeed now)
-    print("\nStep 6: Bob sending encrypted message to Alice...")
-    
-    # Create encryption keys for the message
-    alice_encryption_key = PrivateKey.generate()
-    alice_public_encryption_key = alice_encryption_key.public_key
-    
-    # Bob encrypts a message for Alice
-    message = b"Hello Alice! This is Bob. Permission granted!"
-    sealed_box = SealedBox(alice_public_encryption_key)
-    encrypted = sealed_box.encrypt(message)
-    encrypted_b64 = base64.b64encode(encrypted).decode()
-    
-    response = requests.post(f"{BASE_URL}/send", json={
-        'link_token': alice_link_token,
-        'from_link_token': bob_link_token,
-        'encrypted_message': encrypted_b64
-    })
-    
-    if response.status_code == 201:
-        print(f"✓ Message sent successfully (ID: {response.json()['id']})")
-    else:
-        print(f"✗ Failed to send message: {response.json()}")
-    
-    # Step 7: Test - Try another user without permission (should fail)
-    print("\nStep 7: Testing permission enforcement...")
-    
-    charlie_signing_key = SigningKey.generate()
-    charlie_public_key_b64 = base64.b64encode(bytes(charlie_signing_key.verify_key)).decode()
-    
-    response = requests.post(f"{BASE_URL}/register", json={
-        'public_key': charlie_public_key_b64,
-        'display_name': 'Charlie'
-    })
-    charlie_data = response.json()
-    charlie_link_token = charlie_data['link_token']
-    print(f"✓ Charlie registered: {charlie_link_token}")
-    
-    # Charlie tries to send without permission
-    response = requests.post(f"{BASE_URL}/send", json={
-        'link_token': alice_link_token,
-        'from_link_token': charlie_link_token,
-        'encrypted_message': encrypted_b64
-    })
-    
-    if response.status_code == 403:
+    # One keep-alive connection reused across every step
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+    
+    with session:
+        print("\n=== Testing Permission-Based Messaging Workflow ===\n")
+        
+        # Step 1: Create the clients (Alice, Bob, and Charlie for Step 7)
+        print("Step 1: Registering two clients (Alice and Bob)...")
+        
+        alice_signing_key = SigningKey.generate()
+        alice_public_key_b64 = base64.b64encode(bytes(alice_signing_key.verify_key)).decode()
+        bob_signing_key = SigningKey.generate()
+        bob_public_key_b64 = base64.b64encode(bytes(bob_signing_key.verify_key)).decode()
+        charlie_signing_key = SigningKey.generate()
+        charlie_public_key_b64 = base64.b64encode(bytes(charlie_signing_key.verify_key)).decode()
+        
+        # All three registrations are independent, so they go in one batch
+        (_, alice_data), (_, bob_data), (_, charlie_data) = run_batch(
+            session,
+            ('/register', {'public_key': alice_public_key_b64, 'display_name': 'Alice'}),
+            ('/register', {'public_key': bob_public_key_b64, 'display_name': 'Bob'}),
+            ('/register', {'public_key': charlie_public_key_b64, 'display_name': 'Charlie'})
+        )
+        assert all(data and 'link_token' in data for data in (alice_data, bob_data, charlie_data))
+        alice_link_token = alice_data['link_token']
+        alice_fetch_token = alice_data['fetch_token']
+        print(f"✓ Alice registered: {alice_link_token}")
+        bob_link_token = bob_data['link_token']
+        bob_fetch_token = bob_data['fetch_token']
+        print(f"✓ Bob registered: {bob_link_token}")
+        charlie_link_token = charlie_data['link_token']
+        
+        alice_auth = {'Authorization': f'Bearer {alice_fetch_token}'}
+        
+        # Steps 2-4 only need the tokens from Step 1; the batch runs them in order
+        (_, contact_info), (_, request_data), (_, requests_data) = run_batch(
+            session,
+            ('/check_contact', {'link_token': alice_link_token}),
+            ('/request_message_permission', {
+                'from_link_token': bob_link_token,
+                'to_link_token': alice_link_token,
+                'from_nickname': 'Bob'
+            }),
+            ('/get_message_requests', {'link_token': alice_link_token}, alice_auth)
+        )
+        
+        # Step 2: Bob checks if Alice exists
+        print("\nStep 2: Bob checking if Alice's contact exists...")
+        assert contact_info['exists'] is True
+        print(f"✓ Contact exists: {contact_info['exists']}")
+        print(f"  Nickname: {contact_info.get('nickname')}")
+        
+        # Step 3: Bob requests permission to message Alice
+        print("\nStep 3: Bob requesting permission to message Alice...")
+        assert 'request_id' in request_data, request_data
+        request_id = request_data['request_id']
+        print(f"✓ Permission request sent: Request ID {request_id}")
+        
+        # Step 4: Alice fetches her message requests
+        print("\nStep 4: Alice fetching message requests...")
+        assert [req['id'] for req in requests_data['data']] == [request_id]
+        print(f"✓ Found {len(requests_data['data'])} pending request(s)")
+        for req in requests_data['data']:
+            print(f"  From: {req['from_nickname']} ({req['from_link_token']})")
+        
+        # Create encryption keys for the message
+        alice_encryption_key = PrivateKey.generate()
+        alice_public_encryption_key = alice_encryption_key.public_key
+        
+        # Bob encrypts a message for Alice
+        message = b"Hello Alice! This is Bob. Permission granted!"
+        sealed_box = SealedBox(alice_public_encryption_key)
+        encrypted = sealed_box.encrypt(message)
+        encrypted_b64 = base64.b64encode(encrypted).decode()
+        
+        # Steps 5-6 need request_id, and Bob's send must follow the accept, so
+        # they share one batch. Charlie's send and the anonymous send (Steps
+        # 7-8) don't depend on the accept and run alongside it on the pool
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            futures = {
+                'accept': pool.submit(
+                    run_batch, session,
+                    ('/respond_message_request', {
+                        'link_token': alice_link_token,
+                        'request_id': request_id,
+                        'action': 'accept'
+                    }, alice_auth),
+                    ('/send', {
+                        'link_token': alice_link_token,
+                        'from_link_token': bob_link_token,
+                        'encrypted_message': encrypted_b64
+                    })
+                ),
+                'charlie': pool.submit(session.post, f"{BASE_URL}/send", json={
+                    'link_token': alice_link_token,
+                    'from_link_token': charlie_link_token,
+                    'encrypted_message': encrypted_b64
+                }, timeout=TIMEOUT),
+                'anonymous': pool.submit(session.post, f"{BASE_URL}/send", json={
+                    'link_token': alice_link_token,
+                    'encrypted_message': encrypted_b64
+                }, timeout=TIMEOUT)
+            }
+        
+        (_, accept_data), (bob_status, bob_send) = futures['accept'].result()
+        charlie_response = futures['charlie'].result()
+        charlie_status, charlie_send = charlie_response.status_code, charlie_response.json()
+        anon_status = futures['anonymous'].result().status_code
+        
+        # Step 5: Alice accepts Bob's request
+        print("\nStep 5: Alice accepting Bob's request...")
+        assert accept_data['status'] == 'accepted', accept_data
+        print(f"✓ Request {accept_data['status']}")
+        
+        # Step 6: Bob tries to send message to Alice (should succeed now)
+        print("\nStep 6: Bob sending encrypted message to Alice...")
+        assert bob_status == 201, bob_send
+        print(f"✓ Message sent successfully (ID: {bob_send['id']})")
+        
+        # Step 7: Test - Try another user without permission (should fail)
+        print("\nStep 7: Testing permission enforcement...")
+        assert charlie_status == 403, charlie_send
+        print(f"✓ Charlie registered: {charlie_link_token}")
+        
         print(f"✓ Permission correctly denied for Charlie")
-        print(f"  Error: {response.json()['error']}")
-    else:
-        print(f"✗ Permission check failed - Charlie was allowed to send")
-    
-    # Step 8: Anonymous sending (backward compatible - no from_link_token)
-    print("\nStep 8: Testing anonymous sending (backward compatible)...")
-    response = requests.post(f"{BASE_URL}/send", json={
-        'link_token': alice_link_token,
-        'encrypted_message': encrypted_b64
-    })
-    
-    if response.status_code == 201:
+        print(f"  Error: {charlie_send['error']}")
+        
+        # Step 8: Anonymous sending (backward compatible - no from_link_token)
+        print("\nStep 8: Testing anonymous sending (backward compatible)...")
+        assert anon_status == 201
         print(f"✓ Anonymous message sent successfully")
-    else:
-        print(f"✗ Anonymous sending failed")
-    
-    print("\n=== Permission Workflow Test Complete ===\n")
+        
+        print("\n=== Permission Workflow Test Complete ===\n")
 
 if __name__ == '__main__':
     test_permission_workflow()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+pytest version of test_new_api.py, test_enhancements.py and test_edge_cases.py
+Shared setup (keys, registration, sealed box) comes from the session fixtures
+in conftest.py. Each test only depends on its own requests, so the module can
+be spread across workers with pytest-xdist (pytest -n 4).
+"""
+
+import base64
+import os
+import time
+
+import pytest
+from nacl.public import PrivateKey, SealedBox
+from nacl.signing import SigningKey
+from nacl.encoding import Base64Encoder
+
+from conftest_fixtures import TIMEOUT, FAKE_CT_B64, b64e, sign_challenge
+
+pytestmark = pytest.mark.usefixtures('server_available')
+
+def new_public_key_b64():
+    return SigningKey.generate().verify_key.encode(encoder=Base64Encoder).decode('utf-8')
+
+def register(post, display_name='Test User'):
+    """Register a fresh client; returns (link_token, auth headers)"""
+    response = post('/register', {"public_key": new_public_key_b64(), "display_name": display_name})
+    assert response.status_code == 201
+    result = response.json()
+    return result['link_token'], {"Authorization": f"Bearer {result['fetch_token']}"}
+
+@pytest.fixture
+def post(session, base_url):
+    def _post(path, body, headers=None):
+        return session.post(f'{base_url}{path}', json=body, headers=headers, timeout=TIMEOUT)
+    return _post
+
+def test_health(session, base_url):
+    response = session.get(f'{base_url}/health', timeout=TIMEOUT)
+    assert response.status_code == 200
+
+def test_register_sanitizes_display_name(post):
+    response = post('/register', {
+        "public_key": new_public_key_b64(),
+        "display_name": "<script>alert('XSS')</script>; DROP TABLE users;"
+    })
+    assert response.status_code == 201
+    assert 'link_token' in response.json()
+
+def test_register_key_type(post):
+    registration_data = {
+        "public_key": new_public_key_b64(),
+        "display_name": "Test User",
+        "key_type": "rsa"
+    }
+    response = post('/register', registration_data)
+    assert response.status_code == 400
+
+    registration_data['key_type'] = 'ed25519'
+    response = post('/register', registration_data)
+    assert response.status_code == 201
+    assert response.json().get('key_type', 'ed25519') == 'ed25519'
+
+@pytest.mark.parametrize('size', [20000, 50000])
+def test_send_rejects_oversized_message(post, link_token, sealed_box, size):
+    response = post('/send', {
+        "link_token": link_token,
+        "encrypted_message": b64e(sealed_box.encrypt(b"A" * size))
+    })
+    assert response.status_code == 413
+
+def test_send_rejects_oversized_metadata(post, link_token):
+    response = post('/send', {
+        "link_token": link_token,
+        "encrypted_message": FAKE_CT_B64,
+        "metadata": {"data": "X" * 5000}
+    })
+    assert response.status_code == 413
+
+def test_send_accepts_list_metadata(post, link_token):
+    response = post('/send', {
+        "link_token": link_token,
+        "encrypted_message": FAKE_CT_B64,
+        "metadata": ["item1", "item2"]
+    })
+    assert response.status_code == 201
+
+@pytest.mark.skipif(not os.environ.get('TEST_MAX_MAILBOX_BYTES'),
+                    reason="set TEST_MAX_MAILBOX_BYTES to the server's MAX_MAILBOX_BYTES")
+def test_send_rejects_when_mailbox_full(post):
+    # Own client, so only this test's messages count against the quota
+    link_token, _ = register(post, "Quota User")
+
+    quota = int(os.environ['TEST_MAX_MAILBOX_BYTES'])
+    message_size = 16 * 1024
+    full_message = b64e(b"\0" * message_size)
+    for _ in range(quota // message_size):
+        response = post('/send', {"link_token": link_token, "encrypted_message": full_message})
+        assert response.status_code == 201
+    response = post('/send', {"link_token": link_token, "encrypted_message": full_message})
+    assert response.status_code == 507
+    assert response.json()['error'] == 'Recipient mailbox is full'
+
+def test_send_rejects_invalid_base64(post, link_token):
+    response = post('/send', {
+        "link_token": link_token,
+        "encrypted_message": "not-valid-base64!!!@#$"
+    })
+    assert response.status_code == 400
+
+def test_challenge_reuse_rejected(post, link_token, signing_key):
+    response = post('/challenge_request', {"link_token": link_token})
+    if response.status_code == 429:
+        pytest.skip("challenge cooldown still active for the shared test client")
+    assert response.status_code == 200
+    nonce = response.json()['challenge']
+
+    fetch_data = {
+        "link_token": link_token,
+        "challenge": nonce,
+        "challenge_signature": sign_challenge(signing_key, nonce)
+    }
+    assert post('/fetch', fetch_data).status_code == 200
+    assert post('/fetch', fetch_data).status_code == 401
+
+def test_send_fetch_decrypt_ack(post):
+    # Own client, so the fetched set is exactly what this test sent
+    signing_key = SigningKey.generate()
+    response = post('/register', {
+        "public_key": signing_key.verify_key.encode(encoder=Base64Encoder).decode('utf-8'),
+        "display_name": "Roundtrip User"
+    })
+    assert response.status_code == 201
+    link_token = response.json()['link_token']
+    headers = {"Authorization": f"Bearer {response.json()['fetch_token']}"}
+
+    encryption_private_key = PrivateKey.generate()
+    sealed_box = SealedBox(encryption_private_key.public_key)
+    plaintexts = [b"Hello from anonymous sender!", b"This is the second encrypted message!"]
+    message_ids = []
+    for plaintext in plaintexts:
+        response = post('/send', {
+            "link_token": link_token,
+            "encrypted_message": b64e(sealed_box.encrypt(plaintext)),
+            "metadata": {"sender_nick": "Anonymous"}
+        })
+        assert response.status_code == 201
+        message_ids.append(response.json()['id'])
+
+    response = post('/challenge_request', {"link_token": link_token})
+    assert response.status_code == 200
+    nonce = response.json()['challenge']
+    response = post('/fetch', {
+        "link_token": link_token,
+        "challenge": nonce,
+        "challenge_signature": sign_challenge(signing_key, nonce)
+    })
+    assert response.status_code == 200
+    unsealed_box = SealedBox(encryption_private_key)
+    decrypted = {unsealed_box.decrypt(base64.b64decode(msg['encrypted_message']))
+                 for msg in response.json()['data']}
+    assert decrypted == set(plaintexts)
+
+    response = post('/ack', {"link_token": link_token, "message_ids": message_ids}, headers)
+    assert response.status_code == 200
+    assert response.json()['count'] == len(message_ids)
+
+    response = post('/fetch', {"link_token": link_token, "include_seen": True}, headers)
+    assert response.status_code == 200
+    assert all(msg['seen'] for msg in response.json()['data'])
+
+def test_pagination(post, link_token, auth_headers):
+    message_ids = []
+    for i in range(5):
+        response = post('/send', {"link_token": link_token, "encrypted_message": FAKE_CT_B64})
+        assert response.status_code == 201
+        message_ids.append(response.json()['id'])
+
+    response = post('/fetch', {"link_token": link_token, "limit": 3, "order": "ASC"}, auth_headers)
+    assert response.status_code == 200
+    ids = [msg['id'] for msg in response.json()['data']]
+    assert ids == sorted(ids)
+
+    response = post('/fetch', {"link_token": link_token, "since_id": message_ids[2],
+                               "order": "ASC"}, auth_headers)
+    assert response.status_code == 200
+    assert all(msg['id'] > message_ids[2] for msg in response.json()['data'])
+
+    response = post('/fetch', {"link_token": link_token, "before_id": message_ids[-1],
+                               "limit": 2, "order": "DESC"}, auth_headers)
+    assert response.status_code == 200
+    result = response.json()
+    assert result['count'] <= 2
+    assert all(msg['id'] < message_ids[-1] for msg in result['data'])
+
+@pytest.mark.parametrize('path, extra', [
+    ('/ack', {"message_ids": [999999, 999998]}),
+    ('/ack', {"message_ids": []}),
+    ('/fetch', {"order": "INVALID"}),
+    ('/fetch', {"limit": 300}),
+])
+def test_lenient_parameters(post, link_token, auth_headers, path, extra):
+    response = post(path, {"link_token": link_token, **extra}, auth_headers)
+    assert response.status_code == 200
+    if 'limit' in extra:
+        assert response.json()['count'] <= 200
+
+def test_invalid_fetch_token_rejected(post, link_token):
+    response = post('/fetch', {"link_token": link_token},
+                    {"Authorization": "Bearer invalid_token_12345"})
+    assert response.status_code == 401
+
+def test_send_without_ack_is_queued(post):
+    link_token, headers = register(post, "Queued Send User")
+    response = post('/send', {"link_token": link_token, "encrypted_message": FAKE_CT_B64, "ack": False})
+    assert response.status_code == 202
+    assert response.json()['id'] is None
+
+    # Written with the next buffer flush (100ms window)
+    for _ in range(20):
+        response = post('/fetch', {"link_token": link_token}, headers)
+        assert response.status_code == 200
+        if response.json()['count']:
+            break
+        time.sleep(0.1)
+    assert response.json()['count'] == 1
+
+def test_keyset_pagination_with_created_at_cursor(post):
+    link_token, headers = register(post, "Keyset User")
+    sent_ids = []
+    for _ in range(5):
+        response = post('/send', {"link_token": link_token, "encrypted_message": FAKE_CT_B64})
+        assert response.status_code == 201
+        sent_ids.append(response.json()['id'])
+
+    seen_ids = []
+    body = {"link_token": link_token, "limit": 2, "order": "ASC"}
+    while True:
+        response = post('/fetch', body, headers)
+        assert response.status_code == 200
+        page = response.json()
+        seen_ids.extend(msg['id'] for msg in page['data'])
+        if not page['has_more']:
+            break
+        body.update(since_id=page['next_cursor'], since_created_at=page['next_cursor_created_at'])
+    assert seen_ids == sent_ids
+
+def test_large_fetch_page_is_gzipped(post):
+    link_token, headers = register(post, "Large Page User")
+    send = {'path': '/send', 'body': {"link_token": link_token, "encrypted_message": FAKE_CT_B64}}
+    for _ in range(3):
+        response = post('/batch', {'pipeline': [send] * 20})
+        assert response.status_code == 200
+        assert all(result['status'] == 201 for result in response.json()['results'])
+
+    response = post('/fetch', {"link_token": link_token, "limit": 60},
+                    {**headers, 'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    page = response.json()
+    assert page['count'] == 60
+    assert page['has_more'] is True
+
+def test_batch_runs_steps_in_order(post):
+    link_token, headers = register(post, "Batch User")
+    response = post('/batch', {'pipeline': [
+        {'path': '/check_contact', 'body': {"link_token": link_token}},
+        {'path': '/send', 'body': {"link_token": link_token, "encrypted_message": FAKE_CT_B64}},
+        {'path': '/fetch', 'body': {"link_token": link_token}, 'headers': headers},
+        {'path': '/send', 'body': {"link_token": link_token, "encrypted_message": "not base64!"}},
+    ]})
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert [result['status'] for result in results] == [200, 201, 200, 400]
+    assert results[0]['body']['exists'] is True
+    assert [msg['id'] for msg in results[2]['body']['data']] == [results[1]['body']['id']]
+
+@pytest.mark.parametrize('pipeline', [
+    [],
+    'not a list',
+    [{'path': '/health'}],
+    [{'path': ['/send']}],
+    [{'path': {'/send': 1}}],
+    [{'path': '/send', 'body': ['not', 'an', 'object']}],
+    [{'path': '/check_contact'}] * 21,
+])
+def test_batch_rejects_invalid_pipeline(post, pipeline):
+    response = post('/batch', {'pipeline': pipeline})
+    assert response.status_code == 400
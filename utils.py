@@ -1,35 +1,76 @@
 import hashlib
+import hmac
+import logging
+import os
 import base64
+import binascii
 import secrets
-from nacl.public import PublicKey as NaClPublicKey
+import datetime
+import threading
+import time
+from functools import lru_cache
 from nacl.signing import VerifyKey
 from nacl.exceptions import BadSignatureError
-import re
+
+logger = logging.getLogger('chicrypt.utils')
+
+# Hot-path callables bound once to skip the module attribute lookup per call
+# (VerifyKey and BadSignatureError are already imported by name)
+_b64decode = base64.b64decode
+_blake2b = hashlib.blake2b
+_compare_digest = hmac.compare_digest
 
 def generate_link_token():
     """
     Generate a unique link token
     Returns a URL-safe random string
     """
-    # Generate 24 random bytes -> 32 character base64 string
-    random_bytes = secrets.token_bytes(24)
-    link_token = base64.urlsafe_b64encode(random_bytes).decode('utf-8').rstrip('=')
-    return f"link_{link_token}"
+    # 24 random bytes -> 32 character URL-safe base64 string
+    return f"link_{secrets.token_urlsafe(24)}"
 
 def generate_fetch_token():
     """
     Generate a secure fetch token for authentication
     Returns a long random token
     """
-    # Generate 48 random bytes -> 64 character base64 string
-    random_bytes = secrets.token_bytes(48)
-    return base64.urlsafe_b64encode(random_bytes).decode('utf-8').rstrip('=')
+    # 48 random bytes -> 64 character URL-safe base64 string
+    return secrets.token_urlsafe(48)
+
+# Prefix marking BLAKE2b token hashes; rows without it hold legacy SHA-256 hex
+TOKEN_HASH_PREFIX = 'b2$'
+# Prefix marking keyed BLAKE2b hashes (a MAC under TOKEN_MAC_KEY)
+TOKEN_MAC_PREFIX = 'b2k$'
+
+# Optional server secret for token hashes; with it set, a copy of the clients
+# table alone can't be used to test guessed tokens. BLAKE2b keys are <= 64 bytes
+TOKEN_MAC_KEY = os.getenv('TOKEN_MAC_KEY', '').encode()
+if len(TOKEN_MAC_KEY) > 64:
+    raise ValueError("TOKEN_MAC_KEY must be at most 64 bytes")
+
+def hash_token_bytes(token, key=TOKEN_MAC_KEY):
+    """
+    Raw 32-byte BLAKE2b digest of a token, for in-process comparisons
+    BLAKE2b-256 is as collision resistant as SHA-256 and cheaper to compute.
+    Deliberately not memoized: a cache would keep plaintext bearer tokens
+    (including junk from failed attempts) in memory as keys, and the digest
+    of a 64-character token costs about a microsecond.
+    """
+    return _blake2b(token.encode(), digest_size=32, key=key).digest()
 
 def hash_token(token):
     """
-    Hash a token for secure storage
+    Hash a token for secure storage (prefixed hex of hash_token_bytes)
+    Keyed when TOKEN_MAC_KEY is configured, plain BLAKE2b otherwise.
     """
-    return hashlib.sha256(token.encode()).hexdigest()
+    prefix = TOKEN_MAC_PREFIX if TOKEN_MAC_KEY else TOKEN_HASH_PREFIX
+    return prefix + hash_token_bytes(token).hex()
+
+def tokens_equal(a, b):
+    """
+    Constant-time comparison of tokens or token hashes (both str or both bytes)
+    Lengths aren't secret, so a length mismatch returns early.
+    """
+    return len(a) == len(b) and _compare_digest(a, b)
 
 def generate_challenge_nonce():
     """
@@ -38,59 +79,113 @@ def generate_challenge_nonce():
     random_bytes = secrets.token_bytes(32)
     return base64.b64encode(random_bytes).decode('utf-8')
 
-def validate_public_key(public_key_b64: str) -> bool:
+@lru_cache(maxsize=4096)
+def _get_verify_key(public_key_b64):
+    """
+    Decode a base64 Ed25519 public key into a VerifyKey.
+    Keys are immutable, so parsed keys are memoized per public key.
+    Decoding is lenient (non-alphabet characters such as newlines are
+    skipped) so keys stored before registration became strict keep working;
+    new keys are checked strictly in decode_and_validate_public_key.
+    """
+    return VerifyKey(_b64decode(public_key_b64))
+
+def decode_and_validate_public_key(public_key_b64):
     """
     Validate Ed25519 public key: base64-encoded 32 bytes.
+    Returns the raw key bytes, or None if invalid. The key is decoded once,
+    through the VerifyKey cache, so verify_signature reuses the parsed key.
     We enforce Ed25519 only (no RSA), to match signature verification logic.
     """
+    # 32 bytes encode to exactly 44 base64 characters; reject anything
+    # else before decoding
+    if not isinstance(public_key_b64, str) or len(public_key_b64) != 44:
+        return None
     try:
-        if not isinstance(public_key_b64, str):
-            return False
-        # Base64 decode and length check
-        key_bytes = base64.b64decode(public_key_b64)
-        if len(key_bytes) != 32:
-            return False
-        # Validate it's a valid NaCl public key (curve25519/ed25519 size)
-        NaClPublicKey(key_bytes)
-        # Additionally verify it's usable as Ed25519 verify key
-        VerifyKey(key_bytes)
-        return True
-    except Exception as e:
-        print(f"Public key validation error: {e}")
-        return False
+        # Strict base64 check, then VerifyKey (which rejects anything but
+        # 32 bytes) through the cache
+        _b64decode(public_key_b64, validate=True)
+        return bytes(_get_verify_key(public_key_b64))
+    except (ValueError, TypeError, BadSignatureError, binascii.Error) as e:
+        logger.debug("Public key validation error: %s", e)
+        return None
+
+def validate_public_key(public_key_b64: str) -> bool:
+    """
+    Validate Ed25519 public key (see decode_and_validate_public_key)
+    """
+    return decode_and_validate_public_key(public_key_b64) is not None
 
 def verify_signature(public_key_b64, message, signature_b64):
     """
     Verify an Ed25519 signature
     public_key_b64: base64 encoded public key (32 bytes)
     message: bytes to verify
-    signature_b64: base64 encoded signature
+    signature_b64: base64 encoded signature, or the raw 64 signature bytes
     """
     try:
-        public_key_bytes = base64.b64decode(public_key_b64)
-        signature_bytes = base64.b64decode(signature_b64)
+        if isinstance(signature_b64, bytes):
+            signature_bytes = signature_b64
+        else:
+            # Ed25519 signatures are 64 bytes, i.e. 88 base64 characters
+            if not isinstance(signature_b64, str) or len(signature_b64) != 88:
+                return False
+            signature_bytes = _b64decode(signature_b64, validate=True)
         
-        # Create VerifyKey from the public key
-        verify_key = VerifyKey(public_key_bytes)
+        # Get the (cached) VerifyKey for the public key
+        verify_key = _get_verify_key(public_key_b64)
         
         # Verify the signature
         verify_key.verify(message, signature_bytes)
         return True
         
-    except BadSignatureError:
+    except (BadSignatureError, binascii.Error):
         return False
     except Exception as e:
-        print(f"Signature verification error: {e}")
+        logger.debug("Signature verification error: %s", e)
         return False
 
+# Shared pool for signature checks. libsodium releases the GIL, so checks
+# submitted together run in parallel across cores
+_verify_pool = None
+_verify_pool_lock = threading.Lock()
+
+def _get_verify_pool():
+    """Create the verification pool on first use (real OS threads under gevent)"""
+    global _verify_pool
+    if _verify_pool is None:
+        with _verify_pool_lock:
+            if _verify_pool is None:
+                try:
+                    from gevent import monkey
+                    green_threads = monkey.is_module_patched('threading')
+                except ImportError:
+                    green_threads = False
+                if green_threads:
+                    # The patched stdlib pool would only run greenlets on one core
+                    from gevent.threadpool import ThreadPoolExecutor
+                else:
+                    from concurrent.futures import ThreadPoolExecutor
+                _verify_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _verify_pool
+
+def verify_signature_async(public_key_b64, message, signature_b64):
+    """
+    Run verify_signature on the shared pool
+    Returns a Future whose result is the bool from verify_signature; submit
+    several before waiting to overlap their verification.
+    """
+    return _get_verify_pool().submit(verify_signature, public_key_b64, message, signature_b64)
+
+# Potentially dangerous characters, deleted in one str.translate pass
+_SANITIZE_TABLE = str.maketrans('', '', '<>"\';()&+')
+
 def sanitize_input(data):
     """
     Sanitize input data to prevent injection attacks
     """
     if isinstance(data, str):
-        # Remove potentially dangerous characters
-        sanitized = re.sub(r'[<>"\';()&+]', '', data)
-        return sanitized.strip()
+        return data.translate(_SANITIZE_TABLE).strip()
     return data
 
 def validate_secure_link(link):
@@ -100,25 +195,18 @@ def validate_secure_link(link):
     if not isinstance(link, str):
         return False
         
-    # Check length and character set
-    if len(link) != 32:
-        return False
-        
-    # Check if it contains only hexadecimal characters
-    if not re.match(r'^[a-f0-9]{32}$', link):
+    # 32 lowercase hex characters; fromhex skips whitespace, so the decoded
+    # length must be checked too (all-digit links aren't islower())
+    try:
+        return len(link) == 32 and len(bytes.fromhex(link)) == 16 and link == link.lower()
+    except ValueError:
         return False
-        
-    return True
 
 def create_response(success=True, message="", data=None, error_code=None):
     """
     Create standardized API response
     """
-    response = {
-        'success': success,
-        'message': message,
-        'timestamp': None
-    }
+    response = {'success': success, 'message': message}
     
     if data is not None:
         response['data'] = data
@@ -128,12 +216,24 @@ def create_response(success=True, message="", data=None, error_code=None):
         
     return response
 
+# Security events come in bursts, so the UTC timestamp is formatted at most
+# once per second: [epoch second, formatted string]
+_ts_cache = [0, '']
+
+def _utc_timestamp():
+    now = int(time.time())
+    cached = _ts_cache
+    if cached[0] != now:
+        formatted = datetime.datetime.fromtimestamp(now, datetime.timezone.utc).isoformat(timespec='seconds')
+        cached[:] = [now, formatted]
+        return formatted
+    return cached[1]
+
 def log_security_event(event_type, details, client_ip=None):
     """
     Log security-related events for monitoring
     """
-    import datetime
-    timestamp = datetime.datetime.utcnow().isoformat()
+    timestamp = _utc_timestamp()
     
     log_entry = {
         'timestamp': timestamp,
@@ -143,6 +243,6 @@ def log_security_event(event_type, details, client_ip=None):
     }
     
     # In production, you might want to send this to a logging service
-    print(f"Security Event: {log_entry}")
+    logger.info("Security Event: %s", log_entry)
     
-    return log_entry
\ No newline at end of file
+    return log_entry